@@ -1,40 +1,280 @@
-from typing import List
+from typing import Iterator, List, Optional
+import json
 import tempfile
 import os
 import shutil
 
 from fastapi import FastAPI
-from fastapi import UploadFile
+from fastapi import UploadFile, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 
 from src import use_cases
+from src import uploads
+from src.cache import cache, get_transcription_key
+from src.env import MODEL_NAMES, UPLOAD_MAX_MB
+from src.jobs import Job, JobStatus, QueueFull, job_manager
+from src.warmup import Readiness, warmup
+
+# seconds between keep-alive comments on event streams
+EVENT_KEEP_ALIVE = 15
+# HIT when the result comes from the transcription cache, MISS otherwise
+CACHE_HEADER = "X-STT-Cache"
 
 app = FastAPI()
 
+@app.on_event("startup")
+def start_warmup():
+    """preload and warm up the models without blocking the server start"""
+    warmup.start()
+
+
 @app.get("/")
 def health_check():
     return "STT is running"
 
-@app.post("/transcribe_chunk_by_chunk")
-def transcribe_chunk_by_chunk_api(file: UploadFile, language: str = "zh") -> use_cases.Transcriptions:
+
+@app.get("/ready")
+def readiness_check() -> Readiness:
+    """503 until every configured model is loaded and warm"""
+    readiness = warmup.readiness()
+    return JSONResponse(readiness.dict(), status_code=200 if readiness.ready else 503)
+
+
+def check_model_name(model: Optional[str]):
+    if model is not None and model not in MODEL_NAMES:
+        raise HTTPException(status_code=400, detail=f"Invalid model: {model}, choose from {MODEL_NAMES}")
+
+
+def raise_upload_error(e: Exception):
+    if isinstance(e, uploads.UploadTooLarge):
+        raise HTTPException(status_code=413, detail=str(e))
+    if isinstance(e, uploads.UnsupportedFormat):
+        raise HTTPException(status_code=415, detail=str(e))
+    raise e
+
+
+def cache_header(hit: bool) -> dict:
+    return {CACHE_HEADER: "HIT" if hit else "MISS"}
+
+
+def save_upload(file: UploadFile) -> tuple:
+    """copy the upload to a new temp folder block by block
+    Returns:
+        tuple: (temp_folder, temp_file_path, sha-256 of the upload)
+    """
     temp_folder = tempfile.mkdtemp()
-    # temp_folder = "temp_test"
-    os.makedirs(temp_folder, exist_ok=True)
-    temp_file_path = os.path.join(temp_folder, file.filename)
-    with open(temp_file_path, "wb") as f:
-        f.write(file.file.read())
-    transcriptions = use_cases.transcribe_chunk_by_chunk(temp_folder, temp_file_path, language)
-    shutil.rmtree(temp_folder, ignore_errors=True)
+    temp_file_path = os.path.join(temp_folder, os.path.basename(file.filename))
+    try:
+        writer = uploads.save_upload(file.file, temp_file_path)
+    except (uploads.UploadTooLarge, uploads.UnsupportedFormat) as e:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        raise_upload_error(e)
+    return temp_folder, temp_file_path, writer.digest
+
+
+def transcribe_cached(response: Response, file: UploadFile, cache_key_args: tuple, transcribe) -> use_cases.Transcriptions:
+    """serve the transcription from the cache or transcribe the upload and cache the result
+    transcribe: callable(temp_folder, temp_file_path) -> Transcriptions
+    """
+    temp_folder, temp_file_path, digest = save_upload(file)
+    try:
+        key = get_transcription_key(digest, *cache_key_args)
+        transcriptions = cache.get(key)
+        response.headers.update(cache_header(transcriptions is not None))
+        if transcriptions is None:
+            transcriptions = transcribe(temp_folder, temp_file_path)
+            cache.put(key, transcriptions)
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+    transcriptions.file_name = os.path.basename(temp_file_path)
+    return transcriptions
+
+
+@app.post("/transcribe_chunk_by_chunk")
+def transcribe_chunk_by_chunk_api(response: Response, file: UploadFile, language: str = "zh", model: Optional[str] = None) -> use_cases.Transcriptions:
+    check_model_name(model)
+    transcriptions = transcribe_cached(
+        response,
+        file,
+        (language, model, "chunk_by_chunk"),
+        lambda temp_folder, temp_file_path: use_cases.transcribe_chunk_by_chunk(temp_folder, temp_file_path, language, model),
+    )
     return transcriptions.dict()
 
 
 @app.post("/transcribe")
-def transcribe_file_api(file: UploadFile) -> use_cases.Transcriptions:
-    temp_folder = tempfile.mkdtemp()
-    # temp_folder = "temp_test"
-    os.makedirs(temp_folder, exist_ok=True)
-    temp_file_path = os.path.join(temp_folder, file.filename)
-    with open(temp_file_path, "wb") as f:
-        f.write(file.file.read())
-    transcriptions = use_cases.transcribe(temp_folder,temp_file_path)
-    shutil.rmtree(temp_folder, ignore_errors=True)
+def transcribe_file_api(response: Response, file: UploadFile, model: Optional[str] = None) -> use_cases.Transcriptions:
+    check_model_name(model)
+    transcriptions = transcribe_cached(
+        response,
+        file,
+        ("", model, "full"),
+        lambda temp_folder, temp_file_path: use_cases.transcribe(temp_folder, temp_file_path, model),
+    )
     return transcriptions.dict()
+
+
+def get_job_or_404(job_id: str):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job
+
+
+@app.post("/jobs", status_code=202)
+def submit_job_api(response: Response, file: UploadFile, language: str = "zh", model: Optional[str] = None):
+    """queue a chunk by chunk transcription, returns the job id
+    the job is done at once when the result is in the cache
+    """
+    check_model_name(model)
+    temp_folder, temp_file_path, digest = save_upload(file)
+    try:
+        job = job_manager.submit(
+            temp_folder,
+            temp_file_path,
+            language,
+            model,
+            cache_key=get_transcription_key(digest, language, model),
+        )
+    except QueueFull as e:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        raise HTTPException(status_code=503, detail=str(e))
+    response.headers.update(cache_header(job.cached))
+    return {"job_id": job.id, "status": job.status}
+
+
+async def submit_raw_job(request: Request, filename: str, language: str, model: Optional[str]) -> Job:
+    """queue a transcription from the raw request body
+    the body is streamed to disk and decoded while it arrives when the format allows it
+    """
+    check_model_name(model)
+    content_length = request.headers.get("content-length")
+    if content_length and int(content_length) > UPLOAD_MAX_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {UPLOAD_MAX_MB} MB")
+    temp_folder = tempfile.mkdtemp()
+    writer = uploads.UploadWriter(
+        os.path.join(temp_folder, os.path.basename(filename) or "upload"),
+        os.path.join(temp_folder, "audio.pcm"),
+    )
+    try:
+        async for data in request.stream():
+            await run_in_threadpool(writer.write, data)
+        await run_in_threadpool(writer.close)
+    except Exception as e:
+        writer.abort()
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        raise_upload_error(e)
+    try:
+        job = job_manager.submit(
+            temp_folder,
+            writer.file_path,
+            language,
+            model,
+            decoded=writer.decoded,
+            cache_key=get_transcription_key(writer.digest, language, model),
+        )
+    except QueueFull as e:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        raise HTTPException(status_code=503, detail=str(e))
+    return job
+
+
+def format_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+def iter_job_events(job: Job, cancel_on_close: bool = False) -> Iterator[str]:
+    """server-sent events of a job
+    event `transcription`: one Transcription per chunk, in order
+    event `done`: job status when all chunks are transcribed
+    event `error`: job status when the job failed or was cancelled
+    """
+    chunks_sent = 0
+    try:
+        yield format_event("status", json.dumps(job.status_dict()))
+        while True:
+            chunks, finished = job.wait_for_chunks(chunks_sent, EVENT_KEEP_ALIVE)
+            for chunk in chunks:
+                yield format_event("transcription", chunk.json())
+            chunks_sent += len(chunks)
+            if finished:
+                break
+            if not chunks:
+                yield ": keep-alive\n\n"
+        event = "done" if job.status == JobStatus.done else "error"
+        yield format_event(event, json.dumps(job.status_dict()))
+    finally:
+        # client disconnected before the end
+        if cancel_on_close and not job.is_finished:
+            job_manager.cancel(job.id)
+
+
+def stream_job_events(job: Job, cancel_on_close: bool = False) -> StreamingResponse:
+    return StreamingResponse(
+        iter_job_events(job, cancel_on_close),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            **cache_header(job.cached),
+        },
+    )
+
+
+@app.post("/jobs/raw", status_code=202)
+async def submit_raw_job_api(request: Request, filename: str = "upload", language: str = "zh", model: Optional[str] = None):
+    """same as /jobs, the file is the raw request body and is decoded while it arrives"""
+    job = await submit_raw_job(request, filename, language, model)
+    return JSONResponse(
+        {"job_id": job.id, "status": job.status.value},
+        status_code=202,
+        headers=cache_header(job.cached),
+    )
+
+
+@app.post("/transcribe_stream")
+async def transcribe_stream_api(request: Request, filename: str = "upload", language: str = "zh", model: Optional[str] = None):
+    """transcribe the raw request body, stream each chunk as a server-sent event as soon as it is transcribed
+    the job is cancelled when the client disconnects
+    """
+    job = await submit_raw_job(request, filename, language, model)
+    return stream_job_events(job, cancel_on_close=True)
+
+
+@app.get("/jobs/{job_id}/events")
+def get_job_events_api(job_id: str):
+    """server-sent events of the chunks of a job, starting from the first chunk"""
+    return stream_job_events(get_job_or_404(job_id))
+
+
+@app.get("/jobs/{job_id}")
+def get_job_api(job_id: str):
+    """job status and progress (chunks_done / chunks_total)"""
+    return get_job_or_404(job_id).status_dict()
+
+
+@app.get("/jobs/{job_id}/partial")
+def get_job_partial_api(job_id: str) -> use_cases.Transcriptions:
+    """chunks transcribed so far"""
+    return get_job_or_404(job_id).to_transcriptions().dict()
+
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result_api(response: Response, job_id: str) -> use_cases.Transcriptions:
+    job = get_job_or_404(job_id)
+    response.headers.update(cache_header(job.cached))
+    if job.status == JobStatus.failed:
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status == JobStatus.cancelled:
+        raise HTTPException(status_code=410, detail="Job cancelled")
+    if job.status != JobStatus.done:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status.value}")
+    return job.to_transcriptions().dict()
+
+
+@app.delete("/jobs/{job_id}")
+def cancel_job_api(job_id: str):
+    """cancel a queued or running job"""
+    get_job_or_404(job_id)
+    return job_manager.cancel(job_id).status_dict()
@@ -0,0 +1,264 @@
+"""STT benchmark
+
+Runs the service pipeline (decode, segmentation, inference, postprocess) in-process
+for each backend / compute_type and writes a json report.
+Each configuration runs in its own process, so the peak RSS and the loaded models
+of one configuration do not leak into the next one.
+
+usage (in the stt container, from /workspace):
+    python benchmark.py --seconds 300 --backends openai-whisper,faster-whisper --compute-types default,int8 --concurrency 1,2,4
+    python benchmark.py --audio fixtures/meeting.mp4 --output report.json --baseline previous_report.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+# relative change of the real-time factor reported as a regression
+REGRESSION_THRESHOLD = 0.1
+
+
+def write_synthetic_wav(path: str, seconds: float):
+    """write speech-like synthetic audio as 16kHz mono wav"""
+    import numpy as np
+
+    from src.utils import SAMPLE_RATE
+    from src.warmup import synthetic_audio
+
+    audio = synthetic_audio(seconds)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes((audio * 32767).astype(np.int16).tobytes())
+
+
+def run_pipeline(file_path: str, language: str) -> dict:
+    """transcribe the file like the chunk by chunk endpoint, return the time of each stage in seconds"""
+    from src import use_cases
+    from src import utils
+
+    temp_folder = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        audio = utils.decode_audio(file_path, os.path.join(temp_folder, "audio.pcm"))
+        decode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        audio_chunks = use_cases.split_audio(audio)
+        segmentation_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        chunks = list(use_cases.iter_transcriptions(audio_chunks, language))
+        inference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        use_cases.build_transcriptions(
+            os.path.basename(file_path), utils.get_audio_duration(audio), chunks
+        )
+        postprocess_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+    return {
+        "decode": decode_time,
+        "segmentation": segmentation_time,
+        "inference": inference_time,
+        "postprocess": postprocess_time,
+        "chunks": len(audio_chunks),
+    }
+
+
+def run_worker(args):
+    """benchmark the configuration of the environment, print the result as json"""
+    from src import use_cases
+    from src.env import BACKEND, COMPUTE_TYPE, DEVICE, MODEL_NAME, VAD_ENABLE
+    from src.warmup import synthetic_audio
+
+    result = {
+        "backend": BACKEND,
+        "compute_type": COMPUTE_TYPE,
+        "device": DEVICE,
+        "model": MODEL_NAME,
+        "vad": VAD_ENABLE,
+        "audio_seconds": args.audio_seconds,
+    }
+    start = time.perf_counter()
+    model = use_cases.get_model()
+    result["load_time"] = time.perf_counter() - start
+    start = time.perf_counter()
+    model.warmup(synthetic_audio(5))
+    result["warmup_time"] = time.perf_counter() - start
+
+    stages = run_pipeline(args.audio, args.language)
+    total_time = sum(v for k, v in stages.items() if k != "chunks")
+    result["stages"] = stages
+    result["total_time"] = total_time
+    result["rtf"] = total_time / args.audio_seconds
+
+    result["concurrency"] = []
+    for concurrency in args.concurrency:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            runs = list(
+                executor.map(
+                    lambda _: run_pipeline(args.audio, args.language), range(concurrency)
+                )
+            )
+        wall_time = time.perf_counter() - start
+        latencies = [sum(v for k, v in run.items() if k != "chunks") for run in runs]
+        result["concurrency"].append(
+            {
+                "requests": concurrency,
+                "wall_time": wall_time,
+                # seconds of audio transcribed per second
+                "throughput": concurrency * args.audio_seconds / wall_time,
+                "latency_mean": sum(latencies) / len(latencies),
+                "latency_max": max(latencies),
+            }
+        )
+    # ru_maxrss is in KB on linux
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(result))
+
+
+def get_audio_seconds(path: str) -> float:
+    from src import utils
+
+    temp_folder = tempfile.mkdtemp()
+    try:
+        audio = utils.decode_audio(path, os.path.join(temp_folder, "audio.pcm"))
+        return utils.get_audio_duration(audio)
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+
+def run_config(args, backend: str, compute_type: str, audio_path: str, audio_seconds: float) -> dict:
+    """run one configuration in a child process"""
+    env = dict(
+        os.environ,
+        STT_BACKEND=backend,
+        STT_COMPUTE_TYPE=compute_type,
+        STT_DEVICE=args.device,
+        MODEL_NAME=args.model,
+        STT_MODEL_NAMES=args.model,
+    )
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--worker",
+        "--audio", audio_path,
+        "--audio-seconds", str(audio_seconds),
+        "--language", args.language,
+        "--concurrency", ",".join(str(x) for x in args.concurrency),
+    ]
+    process = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if process.returncode != 0:
+        return {
+            "backend": backend,
+            "compute_type": compute_type,
+            "model": args.model,
+            "error": process.stderr.strip().splitlines()[-1] if process.stderr.strip() else "failed",
+        }
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def compare(results: List[dict], baseline_path: str):
+    """print the rtf change of each configuration against a previous report"""
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    key = lambda x: (x.get("backend"), x.get("compute_type"), x.get("model"))
+    baseline_rtf = {key(x): x["rtf"] for x in baseline["results"] if "rtf" in x}
+    for result in results:
+        if "rtf" not in result or key(result) not in baseline_rtf:
+            continue
+        change = result["rtf"] / baseline_rtf[key(result)] - 1
+        status = "REGRESSION" if change > REGRESSION_THRESHOLD else "ok"
+        print(f"{'/'.join(map(str, key(result)))}: rtf {baseline_rtf[key(result)]:.3f} -> {result['rtf']:.3f} ({change:+.1%}) {status}")
+
+
+def print_summary(results: List[dict]):
+    for result in results:
+        name = f"{result['backend']}/{result['compute_type']}/{result['model']}"
+        if "error" in result:
+            print(f"{name}: error {result['error']}")
+            continue
+        stages = ", ".join(
+            f"{k} {v:.2f}s" for k, v in result["stages"].items() if k != "chunks"
+        )
+        print(f"{name}: rtf {result['rtf']:.3f} ({stages}), peak rss {result['peak_rss_mb']:.0f} MB")
+        for item in result["concurrency"]:
+            print(
+                f"  {item['requests']} requests: {item['throughput']:.1f}s audio/s, "
+                f"latency mean {item['latency_mean']:.1f}s max {item['latency_max']:.1f}s"
+            )
+
+
+def main(args):
+    temp_folder = tempfile.mkdtemp()
+    try:
+        audio_path = args.audio
+        if audio_path is None:
+            audio_path = os.path.join(temp_folder, f"synthetic_{args.seconds}s.wav")
+            write_synthetic_wav(audio_path, args.seconds)
+        audio_seconds = get_audio_seconds(audio_path)
+        results = []
+        for backend in args.backends:
+            for compute_type in args.compute_types:
+                print(f"Benchmark {backend}/{compute_type}/{args.model} on {audio_seconds:.0f}s audio", file=sys.stderr)
+                results.append(run_config(args, backend, compute_type, audio_path, audio_seconds))
+    finally:
+        shutil.rmtree(temp_folder, ignore_errors=True)
+    report = {
+        "created_at": datetime.datetime.now().isoformat(),
+        "host": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "audio": {
+            "path": args.audio or "synthetic",
+            "seconds": audio_seconds,
+            "language": args.language,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print_summary(results)
+    if args.baseline:
+        compare(results, args.baseline)
+    print(f"Report: {args.output}")
+
+
+def split_list(value: str) -> List[str]:
+    return [x.strip() for x in value.split(",") if x.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audio", help="fixture audio or video, synthetic audio when omitted")
+    parser.add_argument("--seconds", type=float, default=300, help="length of the synthetic audio")
+    parser.add_argument("--language", default="zh")
+    parser.add_argument("--model", default=os.environ.get("MODEL_NAME", "turbo"))
+    parser.add_argument("--device", default="auto")
+    parser.add_argument("--backends", type=split_list, default=["openai-whisper", "faster-whisper"])
+    parser.add_argument("--compute-types", type=split_list, default=["default"])
+    parser.add_argument("--concurrency", type=lambda x: [int(i) for i in split_list(x)], default=[1, 2, 4])
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--baseline", help="previous report to compare the real-time factor with")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--audio-seconds", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args)
+    else:
+        main(args)
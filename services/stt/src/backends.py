@@ -0,0 +1,33 @@
+"""model backend registry
+backends are imported on first use, only the configured backend is loaded
+"""
+
+import importlib
+from pydantic import BaseModel
+from src.env import BACKEND, MODEL_NAME, DEVICE, COMPUTE_TYPE, CPU_THREADS
+
+BACKENDS = {
+    "openai-whisper": "src.openai_whisper_model",
+    "faster-whisper": "src.faster_whisper_model",
+}
+
+
+class ModelConfig(BaseModel):
+    backend: str = BACKEND
+    name: str = MODEL_NAME
+    device: str = DEVICE  # auto, cpu or cuda
+    compute_type: str = COMPUTE_TYPE
+    cpu_threads: int = CPU_THREADS
+
+
+def get_model(config: ModelConfig):
+    """get the model of the config, one model is loaded per config"""
+    if config.backend not in BACKENDS:
+        raise ValueError(f"Invalid backend: {config.backend}, choose from {list(BACKENDS)}")
+    module = importlib.import_module(BACKENDS[config.backend])
+    return module.Model(
+        config.name,
+        device=config.device,
+        compute_type=config.compute_type,
+        cpu_threads=config.cpu_threads,
+    )
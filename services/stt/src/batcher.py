@@ -0,0 +1,100 @@
+"""micro-batching scheduler
+chunks submitted by all in-flight requests are collected into batches of up to
+BATCH_SIZE chunks of the same language, a batch waits at most BATCH_MAX_WAIT_MS
+for more chunks, one worker thread per model runs the batches
+"""
+
+import collections
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Deque, Dict, List, NamedTuple
+
+import numpy as np
+
+from src import utils
+from src.env import BATCH_MAX_WAIT_MS, BATCH_SIZE
+
+
+class BatchItem(NamedTuple):
+    audio: np.ndarray  # int16 samples
+    language: str
+    future: Future
+
+
+class Batcher:
+    """batch the chunks of concurrent callers through one model"""
+
+    def __init__(self, model, max_batch_size: int = BATCH_SIZE, max_wait_ms: int = BATCH_MAX_WAIT_MS):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: "queue.Queue[BatchItem]" = queue.Queue()
+        # items received but not batched yet, only used by the worker thread
+        self.pending: Deque[BatchItem] = collections.deque()
+        self.thread = threading.Thread(target=self.work, name="stt-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, audio: np.ndarray, language: str) -> Future:
+        """queue a chunk, the future resolves to its transcription"""
+        future = Future()
+        self.queue.put(BatchItem(audio, language, future))
+        return future
+
+    def count(self, language: str) -> int:
+        return sum(1 for item in self.pending if item.language == language)
+
+    def next_batch(self) -> List[BatchItem]:
+        """wait for the first item, then for more items of its language until the batch is full or max_wait elapsed"""
+        if not self.pending:
+            self.pending.append(self.queue.get())
+        language = self.pending[0].language
+        deadline = time.monotonic() + self.max_wait
+        while self.count(language) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                self.pending.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        batch, rest = [], collections.deque()
+        for item in self.pending:
+            if item.language == language and len(batch) < self.max_batch_size:
+                batch.append(item)
+            else:
+                rest.append(item)
+        self.pending = rest
+        return batch
+
+    def work(self):
+        while True:
+            batch = self.next_batch()
+            batch = [item for item in batch if item.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            logging.debug(f"Batch of {len(batch)} chunks, {len(self.pending) + self.queue.qsize()} waiting")
+            try:
+                texts = self.model.transcribe_batch(
+                    [utils.to_float32(item.audio) for item in batch], batch[0].language
+                )
+            except Exception as e:
+                for item in batch:
+                    item.future.set_exception(e)
+                continue
+            for item, text in zip(batch, texts):
+                item.future.set_result(text)
+
+
+_batchers: Dict[int, Batcher] = {}
+_lock = threading.Lock()
+
+
+def get_batcher(model) -> Batcher:
+    """one batcher per loaded model"""
+    with _lock:
+        if id(model) not in _batchers:
+            _batchers[id(model)] = Batcher(model)
+        return _batchers[id(model)]
@@ -0,0 +1,104 @@
+"""transcription cache
+results are stored as json files named by the hash of (audio sha-256, model, language, options),
+the least recently used files are evicted when the cache exceeds its size
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Optional
+
+from src.env import BACKEND, CACHE_DIR, CACHE_MAX_MB, COMPUTE_TYPE, MODEL_NAME, VAD_ENABLE
+from src.use_cases import Transcriptions
+
+
+def make_key(audio_hash: str, **options) -> str:
+    """cache key of the audio and the options that change the transcription"""
+    data = json.dumps({"audio": audio_hash, **options}, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def get_transcription_key(audio_hash: str, language: str, model_name: Optional[str] = None, mode: str = "chunk_by_chunk") -> str:
+    """cache key of a transcription with the current backend and segmentation settings
+    mode: chunk_by_chunk or full
+    """
+    return make_key(
+        audio_hash,
+        model=model_name or MODEL_NAME,
+        backend=BACKEND,
+        compute_type=COMPUTE_TYPE,
+        language=language,
+        vad=VAD_ENABLE,
+        mode=mode,
+    )
+
+
+class TranscriptionCache:
+    """size bounded on-disk cache, max_bytes 0 disables the cache"""
+
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.folder, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Transcriptions]:
+        if not self.enabled:
+            return None
+        path = self.get_path(key)
+        try:
+            with open(path, "r") as f:
+                transcriptions = Transcriptions(**json.load(f))
+            # mtime is the last access time used by the eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logging.warning(f"Invalid cache file removed: {path}")
+            self.remove(path)
+            return None
+        return transcriptions
+
+    def put(self, key: str, transcriptions: Transcriptions):
+        if not self.enabled:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.get_path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(transcriptions.json())
+        os.replace(temp_path, path)
+        self.evict()
+
+    def remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """remove least recently used files until the cache fits in max_bytes"""
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self.remove(path)
+                total -= size
+                logging.info(f"Cache evicted: {path}")
+
+
+cache = TranscriptionCache(CACHE_DIR, CACHE_MAX_MB * 1024 * 1024)
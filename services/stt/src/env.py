@@ -4,4 +4,50 @@ import logging
 # MODEL_NAME = os.environ.get("MODEL_NAME", "large-v3")
 # MODEL_NAME = os.environ.get("MODEL_NAME", "large")
 MODEL_NAME = os.environ.get("MODEL_NAME", "turbo")
+# models that requests may select, comma separated, defaults to MODEL_NAME
+MODEL_NAMES = [
+    x.strip() for x in (os.environ.get("STT_MODEL_NAMES") or MODEL_NAME).split(",") if x.strip()
+]
 MODEL_DIR = "/workspace/models"
+
+# model backend: openai-whisper or faster-whisper
+BACKEND = os.environ.get("STT_BACKEND", "openai-whisper")
+# auto, cpu or cuda
+DEVICE = os.environ.get("STT_DEVICE", "auto")
+# default, int8, int8_float16, int8_float32, float16, float32 (int8 requires faster-whisper)
+COMPUTE_TYPE = os.environ.get("STT_COMPUTE_TYPE", "default")
+# cpu threads used by the model, 0 uses the library default
+CPU_THREADS = int(os.environ.get("STT_CPU_THREADS", 0))
+
+# number of workers preparing chunks (audio loading, mel spectrogram) in parallel
+WORKERS = int(os.environ.get("STT_WORKERS", 4))
+# number of 30s chunks decoded in one forward pass
+BATCH_SIZE = int(os.environ.get("STT_BATCH_SIZE", 8))
+
+# voice activity detection: skip silence and merge speech regions into 30s windows
+VAD_ENABLE = os.environ.get("STT_VAD", "true").lower() == "true"
+VAD_MIN_SILENCE_MS = int(os.environ.get("STT_VAD_MIN_SILENCE_MS", 1000))
+VAD_SPEECH_PAD_MS = int(os.environ.get("STT_VAD_SPEECH_PAD_MS", 200))
+
+# asynchronous transcription jobs
+JOB_WORKERS = int(os.environ.get("STT_JOB_WORKERS", 1))
+# max queued jobs, new jobs are rejected when the queue is full
+JOB_QUEUE_SIZE = int(os.environ.get("STT_JOB_QUEUE_SIZE", 16))
+# finished jobs are removed after this many seconds
+JOB_TTL = int(os.environ.get("STT_JOB_TTL", 3600))
+
+# uploads are written to disk in blocks of this many bytes
+UPLOAD_CHUNK_SIZE = int(os.environ.get("STT_UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# max upload size in MB
+UPLOAD_MAX_MB = int(os.environ.get("STT_UPLOAD_MAX_MB", 2048))
+
+# transcription cache keyed by the audio content hash, 0 MB disables the cache
+CACHE_DIR = os.environ.get("STT_CACHE_DIR", "/workspace/cache")
+CACHE_MAX_MB = int(os.environ.get("STT_CACHE_MAX_MB", 1024))
+
+# micro-batching: chunks of concurrent requests are batched up to BATCH_SIZE,
+# a batch waits at most this many ms for more chunks
+BATCH_MAX_WAIT_MS = int(os.environ.get("STT_BATCH_MAX_WAIT_MS", 50))
+
+# seconds of synthetic audio decoded by each model at startup
+WARMUP_SECONDS = int(os.environ.get("STT_WARMUP_SECONDS", 5))
@@ -1,4 +1,4 @@
-from faster_whisper import WhisperModel
+from faster_whisper import WhisperModel, available_models
 import time
 # model_size = "large-v3"
 # # model_size = "distil-large-v3"
@@ -18,38 +18,84 @@ import time
 #     print("[%.2fs -> %.2fs] %s" % (segment.start, segment.end, segment.text))
 # end = time.time()
 # print(f"Time taken: {end - start} seconds")
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union
+import numpy as np
 import logging
-from src.env import MODEL_DIR
+import threading
+from src.env import MODEL_DIR, WORKERS, VAD_ENABLE
 
 def singletone(cls):
+    """one instance per constructor arguments, e.g. one model per config"""
     instances = {}
+    lock = threading.Lock()
 
     def get_instance(*args, **kwargs):
-        if cls not in instances:
-            instances[cls] = cls(*args, **kwargs)
-        return instances[cls]
+        key = (args, tuple(sorted(kwargs.items())))
+        with lock:
+            if key not in instances:
+                instances[key] = cls(*args, **kwargs)
+        return instances[key]
 
     return get_instance
 
 
 @singletone
 class Model:
-    def __init__(self, model_name: str):
-        if model_name not in ["large-v3"]:
+    def __init__(
+        self,
+        model_name: str,
+        device: str = "auto",
+        compute_type: str = "default",
+        cpu_threads: int = 0,
+    ):
+        """
+        device: auto, cpu or cuda
+        compute_type: default, int8, int8_float16, int8_float32, float16, float32
+        cpu_threads: number of threads per worker on cpu, 0 uses the library default
+        """
+        if model_name not in available_models():
             raise ValueError("Invalid model name")
-        logging.info(f"Loading model: {model_name}")
-        self.model = WhisperModel(model_name, device="cuda", compute_type="float16",download_root=MODEL_DIR)
+        logging.info(f"Loading model: {model_name} ({device}, {compute_type})")
+        # num_workers allows chunks to be transcribed in parallel threads
+        self.model = WhisperModel(
+            model_name,
+            device=device,
+            compute_type=compute_type,
+            cpu_threads=cpu_threads,
+            download_root=MODEL_DIR,
+            num_workers=WORKERS,
+        )
         logging.info(f"Model loaded: {self.model}")
 
-    def transcribe_chunk(self, audio_path: str, language: str = "zh") -> str:
-        if language not in ["zh", "en"]:
+    def transcribe_chunk(self, audio: Union[str, np.ndarray], language: Optional[str] = "zh") -> str:
+        """audio: audio path or 16kHz float32 samples
+        chunks are already speech only when the VAD segmentation is enabled
+        """
+        if language not in ["zh", "en", None]:
             raise ValueError("Invalid language")
 
         result_text = ""
-        segments, info = self.model.transcribe(audio_path, beam_size=5,vad_filter=True)
+        segments, info = self.model.transcribe(audio, language=language, beam_size=5, vad_filter=not VAD_ENABLE)
         for segment in segments:
             result_text += segment.text
         return result_text
     
-    def transcribe(self, audio_path: str) -> str:
-        return self.transcribe_chunk(audio_path)
+    def transcribe_batch(self, audio_list: List[Union[str, np.ndarray]], language: Optional[str] = "zh") -> List[str]:
+        """transcribe chunks in parallel, results keep the input order"""
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            return list(
+                executor.map(
+                    lambda audio: self.transcribe_chunk(audio, language),
+                    audio_list,
+                )
+            )
+
+    def transcribe(self, audio: Union[str, np.ndarray]) -> str:
+        return self.transcribe_chunk(audio)
+
+    def warmup(self, audio: np.ndarray):
+        """run one full decode, the vad filter is off so silence-like audio is still decoded"""
+        segments, _ = self.model.transcribe(audio, language="en", beam_size=5, vad_filter=False)
+        for _ in segments:
+            pass
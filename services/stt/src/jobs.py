@@ -0,0 +1,260 @@
+"""asynchronous transcription jobs
+jobs are processed by a fixed number of worker threads from a bounded queue,
+progress and partial results are updated chunk by chunk
+"""
+
+import enum
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, PrivateAttr
+
+from src import use_cases
+from src import utils
+from src.cache import cache
+from src.env import JOB_QUEUE_SIZE, JOB_TTL, JOB_WORKERS
+from src.use_cases import Transcription, Transcriptions
+
+
+class JobStatus(str, enum.Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+    cancelled = "cancelled"
+
+
+FINISHED_STATUSES = (JobStatus.done, JobStatus.failed, JobStatus.cancelled)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job(BaseModel):
+    id: str
+    file_name: str
+    language: Optional[str] = "zh"  # "auto" detects the language
+    model_name: Optional[str] = None
+    status: JobStatus = JobStatus.queued
+    chunks_done: int = 0
+    chunks_total: Optional[int] = None
+    audio_length: Optional[float] = None
+    chunks: List[Transcription] = []
+    error: Optional[str] = None
+    # result served from the transcription cache
+    cached: bool = False
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    _temp_folder: str = PrivateAttr()
+    _file_path: str = PrivateAttr()
+    _decoded: bool = PrivateAttr(default=False)
+    _cache_key: Optional[str] = PrivateAttr(default=None)
+    _cancel_event: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _condition: threading.Condition = PrivateAttr(default_factory=threading.Condition)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def notify(self):
+        """wake up the listeners waiting for new chunks"""
+        with self._condition:
+            self._condition.notify_all()
+
+    def wait_for_chunks(self, chunks_seen: int, timeout: Optional[float] = None) -> tuple:
+        """wait until chunks after chunks_seen are transcribed or the job finishes
+        Returns:
+            tuple: (new chunks, finished)
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: len(self.chunks) > chunks_seen or self.is_finished, timeout
+            )
+            # chunks are appended before the job finishes, read the status first
+            finished = self.is_finished
+            return self.chunks[chunks_seen:], finished
+
+    def status_dict(self) -> dict:
+        """job status without the chunks"""
+        return self.dict(exclude={"chunks"})
+
+    def to_transcriptions(self) -> Transcriptions:
+        return use_cases.build_transcriptions(
+            self.file_name, self.audio_length or 0.0, list(self.chunks)
+        )
+
+
+class JobManager:
+    """bounded queue of transcription jobs processed by worker threads"""
+
+    def __init__(self, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE, ttl: int = JOB_TTL):
+        self.workers = workers
+        self.ttl = ttl
+        self.queue: "queue.Queue[Job]" = queue.Queue(maxsize=queue_size)
+        self.jobs: Dict[str, Job] = {}
+        self.lock = threading.Lock()
+        self.threads: List[threading.Thread] = []
+
+    def start(self):
+        if self.threads:
+            return
+        for idx in range(self.workers):
+            thread = threading.Thread(
+                target=self.work, name=f"stt-job-worker-{idx}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(
+        self,
+        temp_folder: str,
+        file_path: str,
+        language: Optional[str] = "zh",
+        model_name: Optional[str] = None,
+        decoded: bool = False,
+        cache_key: Optional[str] = None,
+    ) -> Job:
+        """queue a job, the temp folder is owned by the job and removed when it finishes
+        decoded: the audio was already decoded to audio.pcm in the temp folder
+        cache_key: the job is done at once on a cache hit, the result is cached otherwise
+        Raises:
+            QueueFull: the queue is full
+        """
+        self.start()
+        self.cleanup()
+        job = Job(
+            id=uuid.uuid4().hex,
+            file_name=os.path.basename(file_path),
+            language=language,
+            model_name=model_name,
+            created_at=time.time(),
+        )
+        job._temp_folder = temp_folder
+        job._file_path = file_path
+        job._decoded = decoded
+        job._cache_key = cache_key
+        cached = cache.get(cache_key) if cache_key else None
+        if cached is not None:
+            job.cached = True
+            job.audio_length = cached.audio_length
+            job.chunks = cached.chunks
+            job.chunks_total = job.chunks_done = len(cached.chunks)
+            with self.lock:
+                self.jobs[job.id] = job
+            self.finish(job, JobStatus.done)
+            return job
+        with self.lock:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                raise QueueFull(f"Job queue is full ({self.queue.maxsize} jobs)")
+            self.jobs[job.id] = job
+        logging.info(f"Job {job.id} queued: {job.file_name}")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """cancel a job, a running job stops after the current batch"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job._cancel_event.set()
+        # a queued job is finished here, unless a worker starts it in between
+        self.finish(job, JobStatus.cancelled, expected=JobStatus.queued)
+        return job
+
+    def finish(
+        self,
+        job: Job,
+        status: JobStatus,
+        error: Optional[str] = None,
+        expected: Optional[JobStatus] = None,
+    ):
+        """finish the job, expected: only finish a job in this status"""
+        with self.lock:
+            if job.is_finished or (expected is not None and job.status != expected):
+                return
+            job.status = status
+            job.error = error
+            job.finished_at = time.time()
+        job.notify()
+        shutil.rmtree(job._temp_folder, ignore_errors=True)
+        logging.info(f"Job {job.id} {status.value}")
+
+    def cleanup(self):
+        """remove finished jobs older than ttl"""
+        now = time.time()
+        with self.lock:
+            expired = [
+                job_id
+                for job_id, job in self.jobs.items()
+                if job.is_finished and now - job.finished_at > self.ttl
+            ]
+            for job_id in expired:
+                del self.jobs[job_id]
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job.is_finished:
+                    continue
+                self.run(job)
+            finally:
+                self.queue.task_done()
+
+    def run(self, job: Job):
+        with self.lock:
+            # cancelled while queued
+            if job.is_finished:
+                return
+            job.status = JobStatus.running
+            job.started_at = time.time()
+        try:
+            pcm_file_path = os.path.join(job._temp_folder, "audio.pcm")
+            if job._decoded:
+                audio = utils.load_pcm(pcm_file_path)
+            else:
+                audio = utils.decode_audio(job._file_path, pcm_file_path)
+            job.audio_length = utils.get_audio_duration(audio)
+            job.check_cancelled()
+            audio_chunks = use_cases.split_audio(audio)
+            job.chunks_total = len(audio_chunks)
+            for transcription in use_cases.iter_transcriptions(
+                audio_chunks, job.language, job.model_name
+            ):
+                job.check_cancelled()
+                job.chunks.append(transcription)
+                job.chunks_done += 1
+                job.notify()
+            if job._cache_key:
+                cache.put(job._cache_key, job.to_transcriptions())
+            self.finish(job, JobStatus.done)
+        except JobCancelled:
+            self.finish(job, JobStatus.cancelled)
+        except Exception as e:
+            logging.exception(f"Job {job.id} failed")
+            self.finish(job, JobStatus.failed, f"{type(e).__name__}: {e}")
+
+
+job_manager = JobManager()
@@ -1,40 +1,85 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union
+import numpy as np
 import whisper
-
-import whisper
+import torch
 import logging
-from src.env import MODEL_DIR
+import threading
+from src.env import MODEL_DIR, WORKERS
 
 def singletone(cls):
+    """one instance per constructor arguments, e.g. one model per config"""
     instances = {}
+    lock = threading.Lock()
 
     def get_instance(*args, **kwargs):
-        if cls not in instances:
-            instances[cls] = cls(*args, **kwargs)
-        return instances[cls]
+        key = (args, tuple(sorted(kwargs.items())))
+        with lock:
+            if key not in instances:
+                instances[key] = cls(*args, **kwargs)
+        return instances[key]
 
     return get_instance
 
 
 @singletone
 class Model:
-    def __init__(self, model_name: str):
+    def __init__(
+        self,
+        model_name: str,
+        device: str = "auto",
+        compute_type: str = "default",
+        cpu_threads: int = 0,
+    ):
         if model_name not in ["tiny", "base", "small", "medium", "large","turbo"]:
             raise ValueError("Invalid model name")
-        logging.info(f"Loading model: {model_name}")
-        self.model = whisper.load_model(model_name,download_root=MODEL_DIR)
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if compute_type == "default":
+            compute_type = "float16" if device == "cuda" else "float32"
+        if compute_type not in ["float16", "float32"]:
+            raise ValueError(
+                f"openai-whisper backend does not support compute_type {compute_type}, use faster-whisper"
+            )
+        if compute_type == "float16" and device != "cuda":
+            raise ValueError("float16 requires a cuda device")
+        if cpu_threads > 0:
+            torch.set_num_threads(cpu_threads)
+        self.compute_type = compute_type
+        logging.info(f"Loading model: {model_name} ({device}, {compute_type})")
+        self.model = whisper.load_model(model_name, device=device, download_root=MODEL_DIR)
         logging.info(f"Model loaded: {self.model}")
 
-    def transcribe_chunk(self, audio_path: str, language: str = "zh") -> str:
-        if language not in ["zh", "en"]:
-            raise ValueError("Invalid language")
+    @property
+    def fp16(self) -> bool:
+        return self.compute_type == "float16"
 
-        audio = whisper.load_audio(audio_path)
+    def log_mel_spectrogram(self, audio: Union[str, np.ndarray]) -> torch.Tensor:
+        """audio: audio path or 16kHz float32 samples"""
+        if isinstance(audio, str):
+            audio = whisper.load_audio(audio)
         audio = whisper.pad_or_trim(audio)  # pad or trim audio to 30s
-        mel = whisper.log_mel_spectrogram(audio).to(self.model.device)
+        return whisper.log_mel_spectrogram(audio, self.model.dims.n_mels)
+
+    def transcribe_chunk(self, audio: Union[str, np.ndarray], language: Optional[str] = "zh") -> str:
+        return self.transcribe_batch([audio], language)[0]
+
+    def transcribe_batch(self, audio_list: List[Union[str, np.ndarray]], language: Optional[str] = "zh") -> List[str]:
+        """transcribe 30s chunks in one forward pass"""
+        if language not in ["zh", "en", None]:
+            raise ValueError("Invalid language")
+        # prepare the chunks in parallel, audio loading from a path runs ffmpeg
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            mels = list(executor.map(self.log_mel_spectrogram, audio_list))
+        mel = torch.stack(mels).to(self.model.device)
         # _,probs = self.model.detect_language(mel)
-        options = whisper.DecodingOptions(language=language, fp16=True)
-        result = whisper.decode(self.model, mel, options)
-        return result.text
+        options = whisper.DecodingOptions(language=language, fp16=self.fp16)
+        results = whisper.decode(self.model, mel, options)
+        return [result.text for result in results]
     
-    def transcribe(self, audio_path: str) -> str:
-        return self.model.transcribe(audio_path)['text']
+    def transcribe(self, audio: Union[str, np.ndarray]) -> str:
+        return self.model.transcribe(audio, fp16=self.fp16)['text']
+
+    def warmup(self, audio: np.ndarray):
+        """run one batched decode, the path used by the requests"""
+        self.transcribe_batch([audio], "en")
@@ -0,0 +1,93 @@
+"""voice activity detection based segmentation
+speech regions are merged into windows of up to 30s of speech, silence is skipped
+"""
+
+import logging
+from typing import List, Tuple
+
+import numpy as np
+
+from src.utils import AudioChunk, SAMPLE_RATE, to_float32
+from src.env import VAD_MIN_SILENCE_MS, VAD_SPEECH_PAD_MS
+
+# run the vad block by block to avoid a float32 copy of the whole audio
+VAD_BLOCK_SECONDS = 600
+
+
+def detect_speech(audio: np.ndarray) -> List[Tuple[int, int]]:
+    """detect speech regions with the silero vad shipped with faster-whisper
+    Args:
+        audio (np.ndarray): int16 samples
+    Returns:
+        list: (start, end) sample index of each speech region
+    """
+    from faster_whisper.vad import VadOptions, get_speech_timestamps
+
+    vad_options = VadOptions(
+        min_silence_duration_ms=VAD_MIN_SILENCE_MS,
+        speech_pad_ms=VAD_SPEECH_PAD_MS,
+    )
+    regions = []
+    block_samples = VAD_BLOCK_SECONDS * SAMPLE_RATE
+    for offset in range(0, len(audio), block_samples):
+        block = to_float32(audio[offset : offset + block_samples])
+        for timestamp in get_speech_timestamps(block, vad_options):
+            regions.append((offset + timestamp["start"], offset + timestamp["end"]))
+    return regions
+
+
+def merge_speech_regions(
+    regions: List[Tuple[int, int]], max_samples: int
+) -> List[List[Tuple[int, int]]]:
+    """group consecutive speech regions so the speech of each group fits in max_samples
+    regions longer than max_samples are split
+    """
+    groups = []
+    current = []
+    current_samples = 0
+    for start, end in regions:
+        while end - start > max_samples:
+            if current:
+                groups.append(current)
+                current, current_samples = [], 0
+            groups.append([(start, start + max_samples)])
+            start += max_samples
+        if current and current_samples + (end - start) > max_samples:
+            groups.append(current)
+            current, current_samples = [], 0
+        current.append((start, end))
+        current_samples += end - start
+    if current:
+        groups.append(current)
+    return groups
+
+
+def segment_audio(audio: np.ndarray, chunk_length: int) -> List[AudioChunk]:
+    """split audio into chunks of up to chunk_length seconds of speech
+    start/end of each chunk are on the original timeline
+    Args:
+        audio (np.ndarray): int16 samples
+        chunk_length (int): max speech length of a chunk in seconds
+    Returns:
+        list: list of audio chunks
+    """
+    regions = detect_speech(audio)
+    groups = merge_speech_regions(regions, chunk_length * SAMPLE_RATE)
+    chunks = []
+    for group in groups:
+        if len(group) == 1:
+            chunk_audio = audio[group[0][0] : group[0][1]]
+        else:
+            chunk_audio = np.concatenate([audio[start:end] for start, end in group])
+        chunks.append(
+            AudioChunk(
+                start=group[0][0] / SAMPLE_RATE,
+                end=group[-1][1] / SAMPLE_RATE,
+                audio=chunk_audio,
+            )
+        )
+    speech_seconds = sum(end - start for start, end in regions) / SAMPLE_RATE
+    logging.info(
+        f"VAD: {speech_seconds:.1f}s speech of {len(audio) / SAMPLE_RATE:.1f}s audio, {len(chunks)} chunks."
+    )
+    return chunks
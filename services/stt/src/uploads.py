@@ -0,0 +1,245 @@
+"""streaming uploads
+uploads are written to disk block by block with a size limit, the format is sniffed
+from the first bytes and, when the container can be read from a pipe, ffmpeg decodes
+the audio while the upload is still arriving, other formats are probed with ffprobe
+once the upload is complete
+"""
+
+import hashlib
+import logging
+import struct
+import subprocess
+import tempfile
+from typing import BinaryIO, Optional
+
+from src import utils
+from src.env import UPLOAD_CHUNK_SIZE, UPLOAD_MAX_MB
+
+# bytes read before the format is sniffed
+SNIFF_BYTES = 64 * 1024
+
+# formats ffmpeg can decode from a pipe, mp4 only when moov comes before mdat
+STREAMABLE_FORMATS = {"wav", "mp3", "ogg", "flac", "webm", "aac", "mpegts", "mpegps", "flv", "amr"}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+def is_mp4_streamable(head: bytes) -> bool:
+    """mp4 is decodable from a pipe only when the moov box comes before the mdat box"""
+    offset = 0
+    while offset + 8 <= len(head):
+        size, box_type = struct.unpack(">I4s", head[offset : offset + 8])
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if size == 1:
+            if offset + 16 > len(head):
+                return False
+            size = struct.unpack(">Q", head[offset + 8 : offset + 16])[0]
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+
+def probe_audio(file_path: str) -> bool:
+    """True when ffprobe finds an audio stream in the file"""
+    try:
+        process = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "a", "-show_entries", "stream=index", "-of", "csv=p=0", file_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=60,
+        )
+    except FileNotFoundError:
+        # no ffprobe, let the decoder decide
+        return True
+    return process.returncode == 0 and bool(process.stdout.strip())
+
+
+def sniff_format(head: bytes) -> Optional[str]:
+    """guess the container format from the first bytes of the file"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:4] == b"RIFF" and head[8:12] == b"AVI ":
+        return "avi"
+    if head[:4] == b"FORM" and head[8:12] in (b"AIFF", b"AIFC"):
+        return "aiff"
+    if head[4:8] == b"ftyp":
+        return "mp4"
+    if head[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if head[:4] == b"OggS":
+        return "ogg"
+    if head[:4] == b"fLaC":
+        return "flac"
+    if head[:3] == b"ID3":
+        return "mp3"
+    if head[:3] == b"FLV":
+        return "flv"
+    if head[:5] == b"#!AMR":
+        return "amr"
+    if head[:4] == b"caff":
+        return "caf"
+    if head[:4] == b"\x30\x26\xb2\x75":
+        return "asf"
+    if head[:4] == b"\x00\x00\x01\xba":
+        return "mpegps"
+    if len(head) > 188 and head[0] == 0x47 and head[188] == 0x47:
+        return "mpegts"
+    if len(head) >= 2 and head[0] == 0xFF:
+        # adts aac: 1111 1111 1111 x00x, mpeg audio frame sync: 1111 1111 111x xxxx
+        if head[1] & 0xF6 == 0xF0:
+            return "aac"
+        if head[1] & 0xE0 == 0xE0:
+            return "mp3"
+    return None
+
+
+class UploadWriter:
+    """write an upload to disk block by block
+    when pcm_file_path is set and the format allows it, the audio is decoded while the upload arrives
+    Args:
+        file_path (str): upload file path
+        pcm_file_path (str): raw pcm (s16le) file path, None to only save the upload
+        max_bytes (int): max upload size
+    """
+
+    def __init__(self, file_path: str, pcm_file_path: Optional[str] = None, max_bytes: int = UPLOAD_MAX_MB * 1024 * 1024):
+        self.file_path = file_path
+        self.pcm_file_path = pcm_file_path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.decoded = False
+        self.format: Optional[str] = None
+        self.head = b""
+        self.sniffed = False
+        self.file = open(file_path, "wb")
+        self.decoder: Optional[subprocess.Popen] = None
+        # decoder errors, a file so a full pipe can not block the decoder
+        self.decoder_stderr = None
+
+    @property
+    def digest(self) -> str:
+        """sha-256 of the upload"""
+        return self.sha256.hexdigest()
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"Upload exceeds {self.max_bytes // (1024 * 1024)} MB")
+        self.file.write(data)
+        self.sha256.update(data)
+        if not self.sniffed:
+            self.head += data
+            if len(self.head) < SNIFF_BYTES:
+                return
+            self.start(self.head)
+        else:
+            self.feed(data)
+
+    def start(self, head: bytes):
+        """sniff the format, start the decoder when the format can be read from a pipe
+        unknown formats are probed by close()
+        """
+        self.format = sniff_format(head)
+        self.sniffed = True
+        self.head = b""
+        if self.format is None:
+            logging.info("Unknown upload format, probe after upload")
+            return
+        streamable = self.format in STREAMABLE_FORMATS or (
+            self.format == "mp4" and is_mp4_streamable(head)
+        )
+        if self.pcm_file_path and streamable:
+            self.decoder_stderr = tempfile.TemporaryFile()
+            self.decoder = subprocess.Popen(
+                utils.get_decode_command("pipe:0", self.pcm_file_path),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=self.decoder_stderr,
+            )
+            logging.info(f"Decoding {self.format} upload while receiving")
+            self.feed(head)
+
+    def feed(self, data: bytes):
+        if self.decoder is None:
+            return
+        try:
+            self.decoder.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            # decoder failed, the file is decoded after the upload
+            logging.warning("Streaming decoder stopped, decode after upload")
+            self.stop_decoder()
+
+    def stop_decoder(self):
+        self.decoder.kill()
+        self.decoder.wait()
+        self.decoder = None
+        self.close_stderr()
+
+    def close_stderr(self) -> str:
+        """close the decoder error file, return its content"""
+        if self.decoder_stderr is None:
+            return ""
+        self.decoder_stderr.seek(0)
+        stderr = self.decoder_stderr.read().decode("utf-8", errors="ignore")
+        self.decoder_stderr.close()
+        self.decoder_stderr = None
+        return stderr
+
+    def close(self) -> bool:
+        """finish the upload
+        Returns:
+            bool: True if the audio was decoded to pcm_file_path while receiving
+        Raises:
+            UnsupportedFormat: the format is unknown and ffprobe finds no audio
+        """
+        self.file.close()
+        if not self.sniffed:
+            self.start(self.head)
+        if self.format is None and not probe_audio(self.file_path):
+            raise UnsupportedFormat("Unsupported audio or video format")
+        if self.decoder is None:
+            return False
+        self.decoder.communicate()
+        self.decoded = self.decoder.returncode == 0
+        stderr = self.close_stderr()
+        if not self.decoded:
+            logging.warning(f"Streaming decode failed, decode after upload: {stderr}")
+        self.decoder = None
+        return self.decoded
+
+    def abort(self):
+        self.file.close()
+        if self.decoder is not None:
+            self.stop_decoder()
+
+
+def save_upload(src: BinaryIO, file_path: str, pcm_file_path: Optional[str] = None) -> UploadWriter:
+    """copy a file object to disk in blocks of UPLOAD_CHUNK_SIZE
+    Returns:
+        UploadWriter: the closed writer, with the digest and whether the audio was decoded to pcm_file_path
+    """
+    writer = UploadWriter(file_path, pcm_file_path)
+    try:
+        while True:
+            data = src.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+        writer.close()
+        return writer
+    except Exception:
+        writer.abort()
+        raise
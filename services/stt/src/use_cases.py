@@ -1,10 +1,17 @@
-from src.openai_whisper_model import Model
-# from src.faster_whisper_model import Model
+from src import backends
 from src import utils
+from src import segmentation
 from pydantic import BaseModel
 import os
-from src.env import MODEL_NAME
-from typing import List
+import collections
+from src.batcher import get_batcher
+from src.env import MODEL_NAME, MODEL_NAMES, BATCH_SIZE, VAD_ENABLE
+from typing import Iterator, List, Optional, Union
+import numpy as np
+
+# language value that lets the model detect the language
+AUTO_LANGUAGE = "auto"
+
 
 class Transcription(BaseModel):
     text: str
@@ -19,73 +26,126 @@ class Transcriptions(BaseModel):
     transcript: str
 
 
-model = Model(MODEL_NAME)
+def get_model(model_name: Optional[str] = None):
+    """get the model, backend/device/compute_type come from the environment
+    Args:
+        model_name (str): one of MODEL_NAMES, defaults to MODEL_NAME
+    """
+    model_name = model_name or MODEL_NAME
+    if model_name not in MODEL_NAMES:
+        raise ValueError(f"Invalid model name: {model_name}, choose from {MODEL_NAMES}")
+    return backends.get_model(backends.ModelConfig(name=model_name))
+
+
+
+def get_language(language: Optional[str]) -> Optional[str]:
+    """None or "auto" lets the model detect the language"""
+    if language in (None, "", AUTO_LANGUAGE):
+        return None
+    return language
 
 
-def transcribe_chunk(audio_path: str, language: str):
+def transcribe_chunk(audio: Union[str, np.ndarray], language: Optional[str], model_name: Optional[str] = None):
     """transcribe a chunk
     Args:
-        audio_path (str): audio path
-        language (str): language
+        audio (str | np.ndarray): audio path or float32 samples
+        language (str): language, "auto" detects it
+        model_name (str): model name
     Returns:
         str: transcription
     """
 
-    return model.transcribe(audio_path, language)
+    return get_model(model_name).transcribe_chunk(audio, get_language(language))
 
 
-def transcribe_chunk_by_chunk(
-    temp_folder: str, file_path: str, language: str = "zh"
-) -> Transcriptions:
-    """transcribe the file, if file is video convert to audio first, will chunk the audio into 30s segments with 0s overlap
+def split_audio(audio: np.ndarray, chunk_length: int = 30, overlap: int = 0) -> List[utils.AudioChunk]:
+    """split the decoded audio into chunks for the model
+    with VAD enabled, silence is skipped and speech regions are merged into chunks of up to 30s of speech
+    otherwise the audio is cut into fixed windows
     model will trim the audio to 30s if the audio is longer than 30s
-    Args:
-        temp_folder (str): temp folder path
-        file_path (str): file path
-        language (str): language
-    Returns:
-        Transcriptions: transcriptions
     """
-    repakcage_file_path = os.path.join(temp_folder, f"repackage.mp3")
-    utils.repackage_audio(file_path, repakcage_file_path)
-    audio_length = utils.get_audio_duration(repakcage_file_path)
-
-    chunk_length = 30
-    overlap = 0
     if chunk_length < 30:
         # model will trim the audio to 30s
         raise ValueError(
             "chunk_length must be greater or equal to 30, model will trim the audio to 30s"
         )
-    autio_path_list = utils.split_audio_with_overlap(
-        input_file=repakcage_file_path,
-        output_dir=temp_folder,
+    if VAD_ENABLE:
+        # speech only chunks, timestamps stay on the original timeline
+        return segmentation.segment_audio(audio, chunk_length)
+    return utils.split_audio_with_overlap(
+        audio=audio,
         chunk_length=chunk_length,
         overlap=overlap,
     )
-    chunks = []
-    # autio_path_list = [x.path for x in os.scandir(TEMP_FOLDER)]
-    for audio_path in autio_path_list[:2]:
-        audio_filename = os.path.basename(audio_path)
-        start, end = audio_filename.replace(".mp3", "").split("-")
-        text = model.transcribe_chunk(audio_path, language)
-        chunks.append(Transcription(text=text, start=start, end=end))
+
+
+def iter_transcriptions(
+    audio_chunks: List[utils.AudioChunk], language: Optional[str] = "zh", model_name: Optional[str] = None
+) -> Iterator[Transcription]:
+    """transcribe the chunks through the shared batcher, yield the transcription of each chunk in order
+    at most two batches of chunks are in flight, so concurrent requests share the batches
+    language "auto" or None: the language is detected per chunk
+    """
+    language = get_language(language)
+    batcher = get_batcher(get_model(model_name))
+    in_flight = collections.deque()
+    try:
+        for audio_chunk in audio_chunks:
+            in_flight.append((audio_chunk, batcher.submit(audio_chunk.audio, language)))
+            if len(in_flight) >= 2 * BATCH_SIZE:
+                audio_chunk, future = in_flight.popleft()
+                yield Transcription(text=future.result(), start=audio_chunk.start, end=audio_chunk.end)
+        while in_flight:
+            audio_chunk, future = in_flight.popleft()
+            yield Transcription(text=future.result(), start=audio_chunk.start, end=audio_chunk.end)
+    finally:
+        # generator closed early, e.g. cancelled job
+        for _, future in in_flight:
+            future.cancel()
+
+
+def build_transcriptions(file_name: str, audio_length: float, chunks: List[Transcription]) -> Transcriptions:
     return Transcriptions(
-        file_name=os.path.basename(file_path),
+        file_name=file_name,
         audio_length=audio_length,
         chunks=chunks,
         transcript="\n".join([x.text for x in chunks]),
     )
 
+
+def transcribe_chunk_by_chunk(
+    temp_folder: str, file_path: str, language: str = "zh", model_name: Optional[str] = None
+) -> Transcriptions:
+    """transcribe the file, if file is video the audio track is decoded, will chunk the audio into 30s segments with 0s overlap
+    the file is decoded once, chunks are slices of the decoded audio
+    Args:
+        temp_folder (str): temp folder path
+        file_path (str): file path
+        language (str): language
+        model_name (str): model name
+    Returns:
+        Transcriptions: transcriptions
+    """
+    pcm_file_path = os.path.join(temp_folder, "audio.pcm")
+    audio = utils.decode_audio(file_path, pcm_file_path)
+    audio_chunks = split_audio(audio)
+    chunks = list(iter_transcriptions(audio_chunks, language, model_name))
+    return build_transcriptions(
+        os.path.basename(file_path), utils.get_audio_duration(audio), chunks
+    )
+
+
 def transcribe(
     temp_folder: str,
-    file_path: str
+    file_path: str,
+    model_name: Optional[str] = None,
 ):
-    repakcage_file_path = os.path.join(temp_folder, f"repackage.mp3")
-    utils.repackage_audio(file_path, repakcage_file_path)
+    model = get_model(model_name)
+    pcm_file_path = os.path.join(temp_folder, "audio.pcm")
+    audio = utils.decode_audio(file_path, pcm_file_path)
     return Transcriptions(
         file_name=os.path.basename(file_path),
-        audio_length=utils.get_audio_duration(repakcage_file_path),
+        audio_length=utils.get_audio_duration(audio),
         chunks=[],
-        transcript=model.transcribe(repakcage_file_path),
-    )
\ No newline at end of file
+        transcript=model.transcribe(utils.to_float32(audio)),
+    )
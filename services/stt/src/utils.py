@@ -1,9 +1,17 @@
 import subprocess
 import os
 import logging
-import json
-import math
-import shutil
+from typing import List, NamedTuple
+
+import numpy as np
+
+SAMPLE_RATE = 16000  # whisper input sample rate
+
+
+class AudioChunk(NamedTuple):
+    start: float  # in seconds
+    end: float  # in seconds
+    audio: np.ndarray  # int16 pcm view of the decoded audio
 
 
 def convert_video_to_mp3(input_video, output_audio=None):
@@ -13,85 +21,94 @@ def convert_video_to_mp3(input_video, output_audio=None):
         output_audio = os.path.splitext(input_video)[0] + ".mp3"
 
     # ffmpeg command to convert video to mp3
-    cmd = f"ffmpeg -i {input_video} -q:a 0 -map a {output_audio}"
+    cmd = ["ffmpeg", "-i", input_video, "-q:a", "0", "-map", "a", output_audio]
 
     try:
-        subprocess.run(cmd, shell=True, check=True)
+        subprocess.run(cmd, check=True)
         logging.info(f"Conversion successful: {output_audio}")
     except subprocess.CalledProcessError as e:
         logging.error(f"Error during conversion: {e}")
 
 
-def repackage_audio(input_file:str, output_file:str):
-    """repackage audio to avoid audio can't get duration
-    ffmpeg -y -i {input_file} {output_file}
+def get_decode_command(input_file: str, output_file: str) -> List[str]:
+    """ffmpeg command decoding to 16kHz mono s16le, input_file "pipe:0" reads stdin"""
+    cmd = ["ffmpeg", "-v", "error", "-y"]
+    if input_file != "pipe:0":
+        cmd.append("-nostdin")
+    return cmd + [
+        "-i", input_file,
+        "-vn", "-ac", "1", "-ar", str(SAMPLE_RATE),
+        "-f", "s16le", "-acodec", "pcm_s16le",
+        output_file,
+    ]
+
+
+def decode_audio(input_file: str, output_file: str) -> np.ndarray:
+    """decode audio or video once to 16kHz mono pcm
+    the pcm is written to output_file and memory-mapped, chunks are sliced as views
     Args:
         input_file (str): input file path
-        output_file (str): output file path
+        output_file (str): raw pcm (s16le) file path
+    Returns:
+        np.ndarray: int16 samples
     """
-    cmd = f"ffmpeg -y -i {input_file} {output_file}"
+    if not os.path.exists(input_file):
+        raise FileExistsError(f"File {input_file} not exists")
+    cmd = get_decode_command(input_file, output_file)
     try:
-        subprocess.run(cmd, shell=True, check=True)
-        print(f"Repackaged: {input_file} to {output_file}")
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
-        print(f"Error during repackaging: {e}")
+        raise ValueError(f"Failed to decode audio: {e.stderr.decode('utf-8', errors='ignore')}")
+    logging.info(f"Decoded: {input_file} to {output_file}")
+    return load_pcm(output_file)
 
 
-def get_audio_duration(input_file:str):
+def load_pcm(pcm_file: str) -> np.ndarray:
+    """memory-map a raw pcm (s16le) file"""
+    if os.path.getsize(pcm_file) == 0:
+        return np.zeros(0, dtype=np.int16)
+    return np.memmap(pcm_file, dtype=np.int16, mode="r")
+
+
+def to_float32(audio: np.ndarray) -> np.ndarray:
+    """convert int16 pcm to float32 in [-1, 1], the model input format"""
+    return audio.astype(np.float32) / 32768.0
+
+
+def get_audio_duration(audio: np.ndarray) -> float:
     """get audio duration
     Args:
-        input_file (str): input file path
+        audio (np.ndarray): decoded samples
     Returns:
         float: audio duration in seconds
     """
-    cmd = f"ffprobe -v quiet -print_format json -show_format -show_streams {input_file}"
-    result = subprocess.run(
-        cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    info = json.loads(result.stdout.decode("utf-8"))
-    # Extract duration in seconds from the format section
-    duration = float(info["format"]["duration"])
-    return duration
+    return len(audio) / SAMPLE_RATE
 
 
 def split_audio_with_overlap(
-    input_file: str, output_dir: str, chunk_length: int, overlap: int
-):
-    """split audio with overlap
+    audio: np.ndarray, chunk_length: int, overlap: int
+) -> List[AudioChunk]:
+    """split audio with overlap, chunks are views of the decoded audio
     Args:
-        input_file (str): input file path
-        output_dir (str): output directory
+        audio (np.ndarray): decoded samples
         chunk_length (int): chunk length in seconds
         overlap (int): overlap in seconds
     Returns:
-        list: list of audio file paths
+        list: list of audio chunks
     """
-    audio_path_list = []
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    if not os.path.exists(input_file):
-        raise FileExistsError(f"File {input_file} not exists")
-    total_seconds = get_audio_duration(input_file)
-    # Calculate the number of chunks
-    step = chunk_length - overlap
-    chunks = int(math.ceil((total_seconds - overlap) / step))
-    for i in range(chunks):
-        start_time = i * step
-        end_time = start_time + chunk_length
-
-        # if last chunk is less than chunk_length, set it to total_seconds
-        if i == chunks - 1:
-            end_time = total_seconds
-
-        output_file = os.path.join(output_dir, f"{int(start_time)}-{int(end_time)}.mp3")
-
-        # ffmpeg command to extract the chunk
-        cmd = (
-            f"ffmpeg -i {input_file} -ss {start_time} "
-            f"-t {chunk_length} -c copy {output_file} -y"
+    chunks = []
+    step = (chunk_length - overlap) * SAMPLE_RATE
+    chunk_samples = chunk_length * SAMPLE_RATE
+    for start_sample in range(0, len(audio), step):
+        end_sample = min(start_sample + chunk_samples, len(audio))
+        chunks.append(
+            AudioChunk(
+                start=start_sample / SAMPLE_RATE,
+                end=end_sample / SAMPLE_RATE,
+                audio=audio[start_sample:end_sample],
+            )
         )
-        subprocess.run(cmd, shell=True)
-        logging.info(f"Created: {output_file}")
-        audio_path_list.append(os.path.abspath(output_file))
-    logging.info(f"Audio splitting into {len(audio_path_list)} files.")
-    return audio_path_list
+        if end_sample == len(audio):
+            break
+    logging.info(f"Audio splitting into {len(chunks)} chunks.")
+    return chunks
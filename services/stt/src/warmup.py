@@ -0,0 +1,91 @@
+"""model preloading and warm-up
+the configured models are loaded and run once on synthetic audio so the first
+request does not pay for the kernel initialization, the state is reported by /ready
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+from pydantic import BaseModel
+
+from src import segmentation
+from src import use_cases
+from src.env import MODEL_NAMES, VAD_ENABLE, WARMUP_SECONDS
+from src.utils import SAMPLE_RATE
+
+
+class ModelStatus(BaseModel):
+    name: str
+    loaded: bool = False
+    warm: bool = False
+    load_time: Optional[float] = None  # in seconds
+    warmup_time: Optional[float] = None  # in seconds
+    error: Optional[str] = None
+
+
+class Readiness(BaseModel):
+    ready: bool
+    models: List[ModelStatus]
+
+
+def synthetic_audio(seconds: float) -> np.ndarray:
+    """speech-like float32 audio: harmonics of a varying pitch modulated at syllable rate"""
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    pitch = 140 + 30 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * 4 * t))
+    noise = np.random.default_rng(0).normal(0, 0.01, len(t))
+    return (0.3 * voice * envelope + noise).astype(np.float32)
+
+
+class Warmup:
+    """load and warm up models in a background thread"""
+
+    def __init__(self, model_names: List[str] = MODEL_NAMES):
+        self.statuses: Dict[str, ModelStatus] = {
+            name: ModelStatus(name=name) for name in model_names
+        }
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        # no model to serve is never ready
+        return len(self.statuses) > 0 and all(status.warm for status in self.statuses.values())
+
+    def readiness(self) -> Readiness:
+        return Readiness(ready=self.ready, models=list(self.statuses.values()))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="stt-warmup", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        audio = synthetic_audio(WARMUP_SECONDS)
+        if VAD_ENABLE:
+            start = time.perf_counter()
+            segmentation.detect_speech((audio * 32767).astype(np.int16))
+            logging.info(f"VAD warm in {time.perf_counter() - start:.1f}s")
+        for name, status in self.statuses.items():
+            try:
+                start = time.perf_counter()
+                model = use_cases.get_model(name)
+                status.load_time = time.perf_counter() - start
+                status.loaded = True
+                start = time.perf_counter()
+                model.warmup(audio)
+                status.warmup_time = time.perf_counter() - start
+                status.warm = True
+                logging.info(
+                    f"Model {name} loaded in {status.load_time:.1f}s, warm in {status.warmup_time:.1f}s"
+                )
+            except Exception as e:
+                logging.exception(f"Model {name} warm-up failed")
+                status.error = f"{type(e).__name__}: {e}"
+
+
+warmup = Warmup()
@@ -1,11 +1,54 @@
 import env
 
-from use_cases import receive_mails
+from use_cases import receive_mails, subscribe
 from process import process_mail
+from ms.mail import get_assistant_label
 from utils import logger,format_error_message
+from intake import MailIntake, NotificationServer
+import metrics
 import time
+
+
+def init_intake() -> MailIntake:
+    """init the mail intake, push mode wakes up the loop on change notifications"""
+    if env.MAIL_INTAKE_MODE == "push":
+        server = NotificationServer(
+            env.MAIL_PUSH_HOST,
+            env.MAIL_PUSH_PORT,
+            env.MAIL_PUSH_PATH,
+            env.MAIL_PUSH_CLIENT_STATE,
+            env.MAIL_PUSH_TOKEN,
+        )
+        return MailIntake(
+            poll_interval=env.MAIL_POLL_INTERVAL,
+            push_poll_interval=env.MAIL_PUSH_POLL_INTERVAL,
+            server=server,
+            subscribe=lambda subscription: subscribe(
+                env.MAIL_PUSH_NOTIFICATION_URL,
+                env.MAIL_PUSH_CLIENT_STATE,
+                subscription,
+            ),
+        )
+    elif env.MAIL_INTAKE_MODE == "poll":
+        return MailIntake(poll_interval=env.MAIL_POLL_INTERVAL)
+    raise ValueError(f"Invalid mail intake mode: {env.MAIL_INTAKE_MODE}")
+
+
+def export_metrics():
+    if env.MAIL_METRICS_FILE:
+        try:
+            metrics.REGISTRY.write_to_file(env.MAIL_METRICS_FILE)
+        except OSError as e:
+            logger.error(f"Write metrics error: {format_error_message(e)}")
+
+
 def main():
+    if env.MAIL_METRICS_PORT:
+        metrics.serve("0.0.0.0", env.MAIL_METRICS_PORT)
+    intake = init_intake()
+    intake.start()
     while True:
+        intake.ensure_subscription()
         # receive mails
         try:
             mails = receive_mails(filter_read=True)
@@ -14,11 +57,17 @@ def main():
             logger.error(f"Receive mails error: {format_error_message(e)}")
             time.sleep(1)
             continue
+        metrics.QUEUE_DEPTH.set(len(mails))
+        for mail in mails:
+            metrics.MAILS_RECEIVED.inc(assistant=get_assistant_label(mail))
         # # process and reply mails
         for mail in mails:
             logger.info(f"Processing mail: {mail.subject}")
             process_mail(mail)
-        time.sleep(10)
+            metrics.QUEUE_DEPTH.dec()
+            export_metrics()
+        export_metrics()
+        intake.wait()
 
 
 if __name__ == "__main__":
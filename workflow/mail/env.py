@@ -1,4 +1,5 @@
 import os
+import secrets
 
 os.makedirs("logs", exist_ok=True)
 from dotenv import load_dotenv
@@ -43,7 +44,8 @@ AGENTS_CONFIG = load_agents_config(AGENTS_CONFIG_PATH)
 
 CHATBOT_CONFIG = AGENTS_CONFIG["chatbot"]
 print("CHATBOT_CONFIG",CHATBOT_CONFIG)
-DATA_SUMMARIZER_CONFIG = AGENTS_CONFIG["data_summarizer"]
+# one question per mail, an index of the content would be built and dropped for each mail
+DATA_SUMMARIZER_CONFIG = {**AGENTS_CONFIG["data_summarizer"], "qa_retriever": None}
 print("DATA_SUMMARIZER_CONFIG",DATA_SUMMARIZER_CONFIG)
 MEETING_RECAP_CONFIG = AGENTS_CONFIG["meeting_recap"]
 print("MEETING_RECAP_CONFIG",MEETING_RECAP_CONFIG)
@@ -53,4 +55,23 @@ print("WEB_SEARCH_CONFIG",WEB_SEARCH_CONFIG)
 
 
 DATA_FOLDER = DATA_MOUNT_PATH
-MAIL_PROVIDER = os.environ["MAIL_PROVIDER"]
\ No newline at end of file
+MAIL_PROVIDER = os.environ["MAIL_PROVIDER"]
+# MAIL INTAKE
+MAIL_INTAKE_MODE = os.getenv("MAIL_INTAKE_MODE", "poll")  # "poll" or "push"
+MAIL_POLL_INTERVAL = float(os.getenv("MAIL_POLL_INTERVAL", 10))
+# safety net poll interval when push notifications are active
+MAIL_PUSH_POLL_INTERVAL = float(os.getenv("MAIL_PUSH_POLL_INTERVAL", 300))
+MAIL_PUSH_HOST = os.getenv("MAIL_PUSH_HOST", "0.0.0.0")
+MAIL_PUSH_PORT = int(os.getenv("MAIL_PUSH_PORT", 8085))
+MAIL_PUSH_PATH = os.getenv("MAIL_PUSH_PATH", "/notifications")
+# public url that the provider posts notifications to (graph only)
+MAIL_PUSH_NOTIFICATION_URL = os.getenv("MAIL_PUSH_NOTIFICATION_URL")
+MAIL_PUSH_CLIENT_STATE = os.getenv("MAIL_PUSH_CLIENT_STATE") or secrets.token_hex(16)
+# token query parameter of the gmail pub/sub push endpoint, e.g. <url>?token=<MAIL_PUSH_TOKEN>
+MAIL_PUSH_TOKEN = os.getenv("MAIL_PUSH_TOKEN")
+
+# METRICS
+# serve prometheus metrics on http://<host>:<port>/metrics, 0 to disable
+MAIL_METRICS_PORT = int(os.getenv("MAIL_METRICS_PORT", 0))
+# write prometheus metrics to a text file after each mail, empty to disable
+MAIL_METRICS_FILE = os.getenv("MAIL_METRICS_FILE", "")
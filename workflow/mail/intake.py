@@ -0,0 +1,247 @@
+"""
+Mail intake: wake the mail loop on push notifications and fall back to polling.
+
+Microsoft Graph subscriptions and Gmail Pub/Sub push subscriptions both POST
+change notifications to a small local HTTP endpoint. Each notification only
+wakes the main loop, the mails are still fetched through `receive_mails`.
+When no subscription is active the loop polls with the short interval.
+Graph lifecycle notifications (subscription removed, reauthorization required) are
+posted to the same endpoint and make the loop re-subscribe at once.
+Graph notifications are authenticated by their clientState, Gmail pushes by the token
+query parameter of the Pub/Sub push endpoint, e.g. https://bot.example.com/notifications?token=...
+"""
+
+import argparse
+import base64
+import hmac
+import datetime
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
+
+from utils import logger, format_error_message
+
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    """handle graph / gmail push notifications"""
+
+    server: "NotificationServer"
+
+    def send_text(self, status_code: int, text: str = ""):
+        data = text.encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/":
+            self.send_text(404)
+            return
+        self.send_text(200, "Mail intake is running")
+
+    def do_POST(self):
+        parsed_url = urlparse(self.path)
+        if parsed_url.path != self.server.path:
+            self.send_text(404)
+            return
+        # graph subscription validation: echo the token back as plain text
+        query = parse_qs(parsed_url.query)
+        if "validationToken" in query:
+            self.send_text(200, query["validationToken"][0])
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length > 0 else b""
+        try:
+            payload = json.loads(body or b"{}")
+            accepted = self.server.accept(payload, query.get("token", [None])[0])
+        except ValueError as e:
+            self.send_text(400, str(e) or "Invalid json")
+            return
+        if not accepted:
+            self.send_text(403)
+            return
+        self.send_text(202)
+
+    def log_message(self, format, *args):
+        logger.debug(f"[INTAKE] {self.address_string()} {format % args}")
+
+
+class NotificationServer(ThreadingHTTPServer):
+    """local http endpoint that receives change notifications"""
+
+    daemon_threads = True
+
+    def __init__(
+        self, host: str, port: int, path: str, client_state: str, push_token: Optional[str] = None
+    ):
+        super().__init__((host, port), NotificationHandler)
+        self.path = path
+        self.client_state = client_state
+        # token query parameter of the gmail pub/sub push endpoint, gmail pushes are rejected if not set
+        self.push_token = push_token
+        self.event = threading.Event()
+        self.last_notified_at: Optional[float] = None
+        self.last_history_id: Optional[str] = None
+        # set by graph lifecycle notifications, the subscription must be renewed or recreated
+        self.resubscribe_requested = threading.Event()
+
+    def accept(self, payload: dict, token: Optional[str] = None) -> bool:
+        """check the notification and wake up the mail loop
+        graph: {"value": [{"clientState": ..., "changeType": ..., ...}]}
+        graph lifecycle: {"value": [{"clientState": ..., "lifecycleEvent": ..., ...}]}
+        gmail: {"message": {"data": base64({"emailAddress": ..., "historyId": ...})}}, with ?token=push_token
+        token: token query parameter of the request
+        Raises:
+            ValueError: malformed payload
+        """
+        if not isinstance(payload, dict):
+            raise ValueError("Invalid payload")
+        if "value" in payload:
+            if not isinstance(payload["value"], list):
+                raise ValueError("Invalid graph notification")
+            notifications = [
+                x
+                for x in payload["value"]
+                if isinstance(x, dict) and x.get("clientState") == self.client_state
+            ]
+            if not notifications:
+                logger.warning("[INTAKE] graph notification with invalid clientState")
+                return False
+            lifecycle_events = [x["lifecycleEvent"] for x in notifications if "lifecycleEvent" in x]
+            if lifecycle_events:
+                logger.warning(f"[INTAKE] graph lifecycle notification: {lifecycle_events}")
+                if any(x in ("subscriptionRemoved", "reauthorizationRequired") for x in lifecycle_events):
+                    self.resubscribe_requested.set()
+        elif "message" in payload:
+            if not self.push_token or token is None or not hmac.compare_digest(token, self.push_token):
+                logger.warning("[INTAKE] gmail notification with invalid token")
+                return False
+            message = payload["message"]
+            try:
+                if not isinstance(message, dict):
+                    raise ValueError
+                data = json.loads(base64.b64decode(message.get("data", "")))
+                if not isinstance(data, dict):
+                    raise ValueError
+            except ValueError:
+                raise ValueError("Invalid gmail notification data")
+            self.last_history_id = str(data.get("historyId"))
+        else:
+            return False
+        self.last_notified_at = time.time()
+        self.event.set()
+        return True
+
+    def serve_in_background(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class MailIntake:
+    """decide when the mail loop should fetch mails
+
+    poll_interval: wait time when no subscription is active
+    push_poll_interval: wait time when the subscription is active, safety net for lost notifications
+    subscribe: callable(subscription or None) -> subscription, creates or renews the subscription
+    renew_margin: renew the subscription when it expires within this many seconds
+    """
+
+    def __init__(
+        self,
+        poll_interval: float,
+        push_poll_interval: Optional[float] = None,
+        server: Optional[NotificationServer] = None,
+        subscribe: Optional[Callable] = None,
+        renew_margin: float = 300,
+    ):
+        self.poll_interval = poll_interval
+        self.push_poll_interval = push_poll_interval or poll_interval
+        self.server = server
+        self.subscribe = subscribe
+        self.renew_margin = renew_margin
+        self.subscription = None
+        self.event = server.event if server else threading.Event()
+
+    @property
+    def is_push_active(self) -> bool:
+        if self.subscription is None:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self.subscription.expiration > now
+
+    def start(self):
+        """start the notification endpoint and create the subscription"""
+        if self.server is None:
+            logger.info(f"[INTAKE] polling every {self.poll_interval}s")
+            return
+        self.server.serve_in_background()
+        logger.info(
+            f"[INTAKE] listening on {self.server.server_address}{self.server.path}"
+        )
+        self.ensure_subscription()
+
+    def ensure_subscription(self):
+        """create or renew the subscription, fall back to polling on failure"""
+        if self.server is None or self.subscribe is None:
+            return
+        if self.server.resubscribe_requested.is_set():
+            # removed or to reauthorize on the server, renew now (recreated if renewal fails)
+            self.server.resubscribe_requested.clear()
+            logger.info("[INTAKE] re-subscribe after a lifecycle notification")
+        elif self.subscription is not None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            remaining = (self.subscription.expiration - now).total_seconds()
+            if remaining > self.renew_margin:
+                return
+        try:
+            self.subscription = self.subscribe(self.subscription)
+            logger.info(
+                f"[INTAKE] subscription {self.subscription.id} active until {self.subscription.expiration}"
+            )
+        except Exception as e:
+            logger.error(
+                f"[INTAKE] subscription failed, fall back to polling: {format_error_message(e)}"
+            )
+            self.subscription = None
+
+    def wait(self) -> bool:
+        """wait for a notification or the poll interval, return True if notified"""
+        timeout = self.push_poll_interval if self.is_push_active else self.poll_interval
+        notified = self.event.wait(timeout)
+        self.event.clear()
+        return notified
+
+
+def replay_notifications(path: str, url: str, interval: float = 0.0):
+    """replay recorded notifications to the intake endpoint
+    path: json file with a list of notification payloads
+    """
+    with open(path, "r") as f:
+        payloads = json.load(f)
+    for payload in payloads:
+        request = urllib.request.Request(
+            url,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        with urllib.request.urlopen(request) as response:
+            print(f"{response.status} {json.dumps(payload)[:80]}")
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["replay"])
+    parser.add_argument("path", help="json file with a list of notification payloads")
+    parser.add_argument("--url", default="http://localhost:8085/notifications")
+    parser.add_argument("--interval", type=float, default=0.0)
+    args = parser.parse_args()
+    replay_notifications(args.path, args.url, args.interval)
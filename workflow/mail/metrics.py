@@ -0,0 +1,211 @@
+"""
+Mail bot metrics, exported in the Prometheus text format.
+
+Metrics are kept in process memory and exposed on `/metrics` of a small http
+server and/or written to a text file (node_exporter textfile collector).
+"""
+
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelnames: List[str], labelvalues: Tuple[str, ...], extra: str = "") -> str:
+    labels = [
+        f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, labelvalues)
+    ]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """base metric, values are keyed by label values"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Optional[List[str]] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames or []
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def label_values(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {list(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Optional[List[str]] = None, buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.label_values(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            data = self._values[key]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data["buckets"][idx] += 1
+            data["sum"] += value
+            data["count"] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, data in self._values.items():
+            for bound, count in zip(self.buckets, data["buckets"]):
+                labels = format_labels(self.labelnames, key, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(data['sum'])}")
+            lines.append(f"{self.name}_count{labels} {data['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+    def write_to_file(self, path: str):
+        """write metrics to a file, the file is replaced atomically"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.render())
+        os.replace(temp_path, path)
+
+
+REGISTRY = Registry()
+
+MAILS_RECEIVED = REGISTRY.register(
+    Counter("mailbot_mails_received_total", "Mails received", ["assistant"])
+)
+MAILS_PROCESSED = REGISTRY.register(
+    Counter("mailbot_mails_processed_total", "Mails processed", ["assistant", "status"])
+)
+QUEUE_DEPTH = REGISTRY.register(
+    Gauge("mailbot_queue_depth", "Mails received but not processed yet")
+)
+TIME_IN_QUEUE = REGISTRY.register(
+    Histogram("mailbot_time_in_queue_seconds", "Time from mail received to processing start", ["assistant"])
+)
+PROCESSING_TIME = REGISTRY.register(
+    Histogram("mailbot_processing_seconds", "Mail processing time", ["assistant"])
+)
+STAGE_TIME = REGISTRY.register(
+    Histogram("mailbot_stage_seconds", "Processing time per stage (download, extraction, transcription, llm, reply)", ["assistant", "stage"])
+)
+
+
+@contextmanager
+def timer(histogram: Histogram, **labels):
+    """observe the elapsed time of the block"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        data = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str, port: int) -> ThreadingHTTPServer:
+    """serve /metrics in a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,33 +1,89 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, PrivateAttr
+from typing import Callable, List, Optional
 import os
 import base64
+import datetime
 import json
 import env
 
 
+# base64 decode block size, must be a multiple of 4
+DECODE_BLOCK_SIZE = 4 * 1024 * 1024
+
+
 class MailError(Exception):
     pass
 
 
+def decode_base64_to_file(data: str, save_path: str, urlsafe: bool = False):
+    """decode base64 data block by block straight to a file"""
+    decode = base64.urlsafe_b64decode if urlsafe else base64.b64decode
+    # skip the padding so every block except the last one is 4-aligned
+    end = len(data)
+    while end > 0 and data[end - 1] == "=":
+        end -= 1
+    with open(save_path, "wb") as f:
+        for idx in range(0, end, DECODE_BLOCK_SIZE):
+            block = data[idx : min(idx + DECODE_BLOCK_SIZE, end)]
+            f.write(decode(block + "=" * (-len(block) % 4)))
+
+
+class Subscription(BaseModel):
+    """change notification subscription of the mailbox"""
+
+    id: str
+    expiration: datetime.datetime  # timezone aware (utc)
+
+
 class Attachment(BaseModel):
+    """mail attachment, the content is fetched lazily and streamed to disk"""
+
     id: str
     name: str  # with file extension
     size: int
     contentType: str  # mime type
-    contentBytes: str  # base64 encoded
+    contentBytes: Optional[str] = None  # base64 encoded, only set for inline data
+    path: Optional[str] = None  # local file path after the attachment is saved
+    _downloader: Optional[Callable[[str], None]] = PrivateAttr(default=None)
+
+    def set_downloader(self, downloader: Callable[[str], None]):
+        """set the function that streams the attachment content to a file path"""
+        self._downloader = downloader
 
     def save_to_file(self, save_folder: str):
         """save the attachment to a file"""
         os.makedirs(save_folder, exist_ok=True)
         save_path = os.path.join(save_folder, self.name)
-        with open(save_path, "wb") as f:
-            f.write(base64.b64decode(self.contentBytes))
+        # the file only appears at save_path once complete, an interrupted download is not reused
+        temp_path = f"{save_path}.part"
+        try:
+            if self.contentBytes is not None:
+                decode_base64_to_file(self.contentBytes, temp_path)
+            elif self._downloader is not None:
+                self._downloader(temp_path)
+            else:
+                raise MailError(f"Attachment {self.name} has no content")
+            os.replace(temp_path, save_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.path = save_path
         return save_path
 
+    def get_path(self, save_folder: str):
+        """return the local file path, download the attachment if it is not saved yet"""
+        if self.path is not None and os.path.exists(self.path):
+            return self.path
+        return self.save_to_file(save_folder)
+
     def to_bytes(self):
         """return the attachment as bytes"""
-        return base64.b64decode(self.contentBytes)
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                return f.read()
+        if self.contentBytes is not None:
+            return base64.b64decode(self.contentBytes)
+        raise MailError(f"Attachment {self.name} is not saved")
 
 
 class Mail(BaseModel):
@@ -83,11 +139,17 @@ class Mail(BaseModel):
         return os.path.exists(mail_content_path)
 
     def save_to_file(self, data_folder: str):
-        """save the mail to a file"""
+        """save the attachments then the mail to a file
+        mail.json is written last, a mail is saved only when all its attachments are
+        """
         self.data_folder = data_folder
         os.makedirs(data_folder, exist_ok=True)
+        if self.attachments:
+            for attachment in self.attachments:
+                attachment.save_to_file(data_folder)
         mail_content_path = self.mail_content_path
-        with open(mail_content_path, "w") as f:
+        temp_path = f"{mail_content_path}.tmp"
+        with open(temp_path, "w") as f:
             f.write(
                 json.dumps(
                     {
@@ -107,6 +169,4 @@ class Mail(BaseModel):
                     indent=4,
                 )
             )
-        if self.attachments:
-            for attachment in self.attachments:
-                attachment.save_to_file(data_folder)
+        os.replace(temp_path, mail_content_path)
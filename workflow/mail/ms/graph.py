@@ -2,6 +2,9 @@
 
 import requests
 import json
+import threading
+import time
+from typing import Callable, Optional
 
 
 from loguru import logger
@@ -10,6 +13,10 @@ import env
 from ms.data import MailError
 
 
+# retry interval when the background token refresh fails
+TOKEN_RETRY_INTERVAL = 30
+
+
 class MSGraphError(Exception):
     pass
 
@@ -25,7 +32,8 @@ def singleton(cls):
     return get_instance
 
 
-def get_access_token(tenant_id: str, client_id: str, secret: str) -> str:
+def request_access_token(tenant_id: str, client_id: str, secret: str) -> dict:
+    """request an access token, returns {"access_token": ..., "expires_in": seconds, ...}"""
     url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
     scope = "https://graph.microsoft.com/.default"
@@ -40,7 +48,69 @@ def get_access_token(tenant_id: str, client_id: str, secret: str) -> str:
         raise MailError(
             f"Failed to get access token: Response code:{response.status_code} - {json.dumps(response.json())}"
         )
-    return response.json()["access_token"]
+    return response.json()
+
+
+def get_access_token(tenant_id: str, client_id: str, secret: str) -> str:
+    return request_access_token(tenant_id, client_id, secret)["access_token"]
+
+
+class TokenManager:
+    """share an access token across threads and refresh it ahead of expiry
+
+    fetch_token: callable() -> {"access_token": ..., "expires_in": seconds}
+    refresh_margin: refresh the token this many seconds before it expires
+    """
+
+    def __init__(self, fetch_token: Callable[[], dict], refresh_margin: float = 300):
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    @property
+    def is_expiring(self) -> bool:
+        return time.time() >= self._expires_at - self.refresh_margin
+
+    @property
+    def token(self) -> str:
+        if self._token is None or self.is_expiring:
+            with self._lock:
+                # another thread may have refreshed the token while waiting
+                if self._token is None or self.is_expiring:
+                    self._refresh()
+        return self._token
+
+    def refresh(self, stale_token: Optional[str] = None) -> str:
+        """refresh the token, skip if stale_token was already replaced by another thread"""
+        with self._lock:
+            if stale_token is None or self._token == stale_token:
+                self._refresh()
+            return self._token
+
+    def _refresh(self):
+        data = self.fetch_token()
+        self._token = data["access_token"]
+        expires_in = float(data.get("expires_in", 3600))
+        self._expires_at = time.time() + expires_in
+        logger.debug(f"Token updated, expires in {expires_in}s")
+        self._schedule(max(expires_in - self.refresh_margin, 1))
+
+    def _schedule(self, delay: float):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.error(f"Background token refresh failed: {e}")
+            self._schedule(TOKEN_RETRY_INTERVAL)
 
 
 @singleton
@@ -53,7 +123,6 @@ class ENV:
         client_id: str = None,
         secret: str = None,
     ):
-        self._token = None
         self.folder_id = folder_id
         self.user_id = user_id
         self.tenant_id = tenant_id
@@ -76,24 +145,42 @@ class ENV:
             or not self.secret
         ):
             raise MailError("Environment variables are not set")
+        self.token_manager = TokenManager(
+            lambda: request_access_token(self.tenant_id, self.client_id, self.secret)
+        )
+        self.session = requests.Session()
 
     def update_token(self):
-        self._token = get_access_token(self.tenant_id, self.client_id, self.secret)
-        logger.debug(f"Token updated: {self._token}")
+        self.token_manager.refresh()
 
     @property
     def token(self):
-        if self._token is None:
-            self.update_token()
-        return self._token
+        return self.token_manager.token
 
-    @property
-    def headers(self):
+    def make_headers(self, token: str) -> dict:
         return {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.token}",
+            "Authorization": f"Bearer {token}",
         }
 
+    @property
+    def headers(self):
+        return self.make_headers(self.token)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """send a graph request, refresh the token and retry once on 401"""
+        token = self.token
+        response = self.session.request(
+            method, url, headers=self.make_headers(token), **kwargs
+        )
+        if response.status_code == 401:
+            response.close()
+            token = self.token_manager.refresh(stale_token=token)
+            response = self.session.request(
+                method, url, headers=self.make_headers(token), **kwargs
+            )
+        return response
+
 
 def get_users(token: str):
     url = "https://graph.microsoft.com/v1.0/users"
@@ -2,11 +2,14 @@
 This file contains the mail class and functions for interacting with the Microsoft Graph API.
 """
 
-from typing import List
-from ms.data import Mail
+from typing import List, Optional
+from ms.data import Mail, Subscription
 import datetime
 import os
+import time
 import env
+import metrics
+from utils import logger
 
 SAVE_FOLDER = env.DATA_FOLDER
 MAIL_PROVIDER = env.MAIL_PROVIDER
@@ -19,20 +22,47 @@ else:
 
 
 
-def receive_mails(filter_read: bool) -> List[Mail]:
-    """receive mails"""
-    mails = mail_provider.receive_mails(filter_read)
-    for mail in mails:
+def get_assistant_label(mail: Mail) -> str:
+    """metrics label of the assistant, e.g. TOOL-MS"""
+    return f"{mail.category.replace('BotTest', '').upper()}-{mail.assistant.upper()}"
+
 
-        # setup mail save folder
-        today_str = datetime.datetime.now().strftime("%Y-%m-%d")
-        mail_folder = os.path.join(SAVE_FOLDER, today_str, mail.id)
-        mail.set_data_folder(mail_folder)
+def save_mail(mail: Mail) -> bool:
+    """save the mail and its attachments to the data folder
+    returns False if the mail could not be saved, the mail is received again by a later poll
+    """
+    # setup mail save folder
+    today_str = datetime.datetime.now().strftime("%Y-%m-%d")
+    mail_folder = os.path.join(SAVE_FOLDER, today_str, mail.id)
+    mail.set_data_folder(mail_folder)
 
-        # save mail to file if not saved
-        if not mail.is_saved:
+    # save mail to file if not saved
+    if not mail.is_saved:
+        # attachments are downloaded here
+        start = time.perf_counter()
+        try:
             mail.save_to_file(mail_folder)
-    return mails
+        except Exception as e:
+            logger.error(f"Failed to save mail: {mail.id}, error: {e}")
+            return False
+        if mail.attachments:
+            metrics.STAGE_TIME.observe(
+                time.perf_counter() - start,
+                assistant=get_assistant_label(mail),
+                stage="download",
+            )
+    else:
+        # reuse attachments saved by a previous run
+        for attachment in mail.attachments or []:
+            saved_path = os.path.join(mail_folder, attachment.name)
+            if os.path.exists(saved_path):
+                attachment.path = saved_path
+    return True
+
+
+def receive_mails(filter_read: bool) -> List[Mail]:
+    """receive mails, a mail that could not be saved is skipped"""
+    return mail_provider.receive_mails(filter_read, save_mail)
 
 
 def reply_mail(mail: Mail, content: str):
@@ -41,3 +71,16 @@ def reply_mail(mail: Mail, content: str):
     """
     payload = mail_provider.reply_mail(mail, content)
     mail.save_reply(payload)
+
+
+def subscribe(
+    notification_url: str, client_state: str, subscription: Optional[Subscription] = None
+) -> Subscription:
+    """create the change notification subscription or renew the existing one"""
+    if subscription is not None:
+        try:
+            return mail_provider.renew_subscription(subscription)
+        except Exception as e:
+            # subscription may be deleted by the provider, create a new one
+            logger.warning(f"Renew subscription {subscription.id} failed, re-subscribe: {e}")
+    return mail_provider.subscribe(notification_url, client_state)
@@ -1,11 +1,17 @@
 import os
 import base64
-from typing import List
+import datetime
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from loguru import logger
+import threading
+from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from ms.utils import parse_subject, parse_body
-from ms.data import Mail, Attachment
+from ms.data import Mail, Attachment, MailError, Subscription, decode_base64_to_file
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import env
@@ -15,49 +21,94 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify",
     "https://www.googleapis.com/auth/gmail.labels",
 ]
+# pub/sub topic that gmail publishes mailbox changes to
+PUBSUB_TOPIC = os.getenv("GMAIL_PUBSUB_TOPIC")
+# gmail recommends at most 50 requests per batch
+BATCH_SIZE = 50
+METADATA_HEADERS = ["From", "Subject", "Date"]
+# batch sub requests failing with these status are retried with exponential backoff
+RETRY_STATUS = {429, 500, 502, 503, 504}
+BATCH_RETRIES = 3
+BATCH_RETRY_DELAY = 1
+# polls a message is fetched again after a retryable failure before it is dropped
+MAX_MESSAGE_RETRIES = 5
+# last synced history id, used for incremental sync
+HISTORY_PATH = os.path.join(env.DATA_FOLDER, "gmail_history.json")
+# refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 300
+_credentials = None
+_credentials_lock = threading.Lock()
+# failed polls by message id, reset on restart
+_message_retries: Dict[str, int] = {}
+
+
+def get_credentials() -> Credentials:
+    """get the shared credentials, refresh the access token ahead of expiry"""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            if os.path.exists("token.json"):
+                _credentials = Credentials.from_authorized_user_file(
+                    "token.json", SCOPES
+                )
+            else:
+                raise FileNotFoundError("Gmail token.json not found")
+        # expiry is a naive utc datetime
+        expiring = _credentials.expiry is None or (
+            _credentials.expiry - datetime.datetime.utcnow()
+        ) < datetime.timedelta(seconds=TOKEN_REFRESH_MARGIN)
+        if expiring and _credentials.refresh_token:
+            _credentials.refresh(Request())
+            with open("token.json", "w") as f:
+                f.write(_credentials.to_json())
+            logger.debug(f"Gmail token refreshed, expires at {_credentials.expiry}")
+        return _credentials
 
 
 def get_gmail_service():
     """get the gmail service"""
-    if os.path.exists("token.json"):
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
-    else:
-        raise FileNotFoundError("Gmail token.json not found")
+    return build("gmail", "v1", credentials=get_credentials())
 
-    return build("gmail", "v1", credentials=creds)
+
+def download_attachment(service, message_id: str, attachment_id: str, save_path: str):
+    """fetch the attachment and decode it straight to a file"""
+    att = (
+        service.users()
+        .messages()
+        .attachments()
+        .get(userId="me", messageId=message_id, id=attachment_id)
+        .execute()
+    )
+    decode_base64_to_file(att["data"], save_path, urlsafe=True)
 
 
 def get_attachments(service, message: dict):
-    """get attachments from a mail"""
+    """get attachment metadata from a mail, the content is downloaded on save"""
     attachments = []
     # parse attachments
-    for part in message["payload"]["parts"]:
+    for part in message["payload"].get("parts", []):
         if part["filename"]:
-            if "data" in part["body"]:
-                data = part["body"]["data"]
-            else:
-                att_id = part["body"]["attachmentId"]
-                att = (
-                    service.users()
-                    .messages()
-                    .attachments()
-                    .get(userId="me", messageId=message["id"], id=att_id)
-                    .execute()
+            body = part["body"]
+            attachment = Attachment(
+                id=body.get("attachmentId", part.get("partId", "")),
+                name=part["filename"],
+                size=body.get("size", 0),
+                contentType=part["mimeType"],
+            )
+            if "data" in body:
+                # small inline data, gmail encodes it as urlsafe base64
+                attachment.set_downloader(
+                    lambda save_path, data=body["data"]: decode_base64_to_file(
+                        data, save_path, urlsafe=True
+                    )
                 )
-                data = att["data"]
-            file_data = data.encode("UTF-8")
-            path = part["filename"]
-            size = len(file_data)
-            content_type = part["mimeType"]
-            attachments.append(
-                Attachment(
-                    id=att_id,
-                    name=path,
-                    size=size,
-                    contentType=content_type,
-                    contentBytes=file_data,
+            else:
+                attachment.set_downloader(
+                    lambda save_path, attachment_id=body["attachmentId"]: download_attachment(
+                        service, message["id"], attachment_id, save_path
+                    )
                 )
-            )
+            attachments.append(attachment)
     return attachments
 
 
@@ -103,48 +154,179 @@ def mark_mail_as_read(service, message_id: str):
     ).execute()
 
 
+def mark_mails_as_read(service, message_ids: List[str]):
+    """mark mails as read in one request"""
+    if not message_ids:
+        return
+    service.users().messages().batchModify(
+        userId="me", body={"ids": message_ids, "removeLabelIds": ["UNREAD"]}
+    ).execute()
+
+
 def get_email_address(service) -> str:
     """get the email address of the user"""
     profile = service.users().getProfile(userId="me").execute()
     return profile["emailAddress"]
 
 
-def read_mail(service, message_id: str):
+def load_history_id() -> Optional[str]:
+    """load the history id of the last sync"""
+    if not os.path.exists(HISTORY_PATH):
+        return None
+    with open(HISTORY_PATH, "r") as f:
+        return json.load(f).get("historyId")
+
+
+def save_history_id(history_id: str):
+    """save the history id of the last sync"""
+    os.makedirs(os.path.dirname(HISTORY_PATH), exist_ok=True)
+    with open(HISTORY_PATH, "w") as f:
+        json.dump({"historyId": history_id}, f)
+
+
+def is_retryable(exception: Exception) -> bool:
+    """rate limit and server errors are retried"""
+    return isinstance(exception, HttpError) and exception.resp.status in RETRY_STATUS
+
+
+def batch_execute(service, requests: Dict[str, Any]) -> Tuple[Dict[str, dict], List[str]]:
+    """execute api requests through batch http requests
+    requests: request id -> api request
+    returns: request id -> response, rate limited requests are retried with backoff,
+    failed requests are logged and missing from the responses;
+    the ids of the requests still failing with a retryable error
     """
-    Parse a mail from the Google API
+    responses = {}
+    retry_ids = []
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            responses[request_id] = response
+        elif is_retryable(exception):
+            retry_ids.append(request_id)
+        else:
+            logger.error(f"Gmail batch request {request_id} failed: {exception}")
+
+    request_ids = list(requests.keys())
+    for attempt in range(BATCH_RETRIES + 1):
+        if attempt > 0:
+            delay = BATCH_RETRY_DELAY * 2 ** (attempt - 1)
+            logger.warning(f"Retry {len(request_ids)} gmail batch requests in {delay}s")
+            time.sleep(delay)
+        retry_ids = []
+        for idx in range(0, len(request_ids), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id in request_ids[idx : idx + BATCH_SIZE]:
+                batch.add(requests[request_id], request_id=request_id)
+            batch.execute()
+        if not retry_ids:
+            break
+        request_ids = retry_ids
+    else:
+        logger.error(f"Gmail batch requests failed after {BATCH_RETRIES} retries: {retry_ids}")
+    return responses, retry_ids
+
+
+def list_message_ids(service, filter_read: bool) -> List[str]:
+    """list inbox message ids, only the ids are returned"""
+    message_ids = []
+    page_token = None
+    while True:
+        gmail_results = (
+            service.users()
+            .messages()
+            .list(
+                userId="me",
+                labelIds=["INBOX"],
+                q="is:unread" if filter_read else None,
+                pageToken=page_token,
+                fields="messages(id),nextPageToken",
+            )
+            .execute()
+        )
+        message_ids.extend([x["id"] for x in gmail_results.get("messages", [])])
+        page_token = gmail_results.get("nextPageToken")
+        if not page_token:
+            return message_ids
+
+
+def list_history_message_ids(
+    service, start_history_id: str, filter_read: bool
+) -> Tuple[Optional[List[str]], Optional[str]]:
+    """list message ids added to the inbox since start_history_id
+    returns (None, None) if the history id is too old and a full sync is required
     """
-    msg = service.users().messages().get(userId="me", id=message_id).execute()
-    email_data = msg["payload"]["headers"]
-    for values in email_data:
-        name = values["name"]
-        if name == "From":
-            sender = values["value"]
-        if name == "Subject":
-            subject = values["value"]
-        if name == "Date":
-            # Date | Values: Tue, 19 Nov 2024 08:07:35 +0000
-            rawDate = values["value"]
-            receivedDateTime = rawDate.split(",")[1].strip()
-            createdDateTime = rawDate.split(",")[1].strip()
-    attachments = get_attachments(service, msg)
+    message_ids = []
+    history_id = start_history_id
+    page_token = None
+    while True:
+        try:
+            history_results = (
+                service.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=["messageAdded"],
+                    labelId="INBOX",
+                    pageToken=page_token,
+                    fields="history(messagesAdded(message(id,labelIds))),historyId,nextPageToken",
+                )
+                .execute()
+            )
+        except HttpError as e:
+            if e.resp.status == 404:
+                logger.warning(f"Gmail history {start_history_id} expired, full sync")
+                return None, None
+            raise
+        for history in history_results.get("history", []):
+            for added in history.get("messagesAdded", []):
+                message = added["message"]
+                if filter_read and "UNREAD" not in message.get("labelIds", []):
+                    continue
+                if message["id"] not in message_ids:
+                    message_ids.append(message["id"])
+        history_id = history_results.get("historyId", history_id)
+        page_token = history_results.get("nextPageToken")
+        if not page_token:
+            return message_ids, history_id
+
+
+def get_headers(message: dict) -> Dict[str, str]:
+    """get the headers of a mail"""
+    return {x["name"]: x["value"] for x in message["payload"].get("headers", [])}
+
+
+def parse_mail(service, message: dict) -> Mail:
+    """
+    Parse a full format mail from the Google API
+    """
+    headers = get_headers(message)
+    sender = headers["From"]
+    subject = headers["Subject"]
+    # Date | Values: Tue, 19 Nov 2024 08:07:35 +0000
+    rawDate = headers["Date"]
+    receivedDateTime = rawDate.split(",")[-1].strip()
+    createdDateTime = rawDate.split(",")[-1].strip()
+    attachments = get_attachments(service, message)
     if attachments:
         has_attachments = True
     else:
         has_attachments = False
-    text_data, html_data, urls = get_body(msg)
-    category, assistant = parse_subject(subject)  # pylint: disable=E0606
+    text_data, html_data, urls = get_body(message)
+    category, assistant = parse_subject(subject)
 
     mail = Mail(
-        id=message_id,
+        id=message["id"],
         category=category,
         assistant=assistant,
-        createdDateTime=createdDateTime,  # pylint: disable=E0606
-        receivedDateTime=receivedDateTime,  # pylint: disable=E0606
+        createdDateTime=createdDateTime,
+        receivedDateTime=receivedDateTime,
         subject=subject,
         body=text_data,
         urls=urls,
         raw_body=html_data,
-        sender=sender,  # pylint: disable=E0606
+        sender=sender,
         is_read=False,  # check
         has_attachments=has_attachments,
         attachments=attachments,
@@ -152,39 +334,125 @@ def read_mail(service, message_id: str):
     return mail
 
 
-def receive_mails(filter_read: bool) -> List[Mail]:
+def read_mail(service, message_id: str):
+    """
+    Parse a mail from the Google API
+    """
+    msg = service.users().messages().get(userId="me", id=message_id).execute()
+    return parse_mail(service, msg)
+
+
+def hold_message(message_id: str, error: str) -> bool:
+    """count a retryable failure of the message
+    returns True if the message is fetched again by the next poll, False once it is dropped
+    """
+    retries = _message_retries.get(message_id, 0) + 1
+    if retries > MAX_MESSAGE_RETRIES:
+        logger.error(f"Drop mail {message_id} after {MAX_MESSAGE_RETRIES} retries: {error}")
+        _message_retries.pop(message_id, None)
+        return False
+    _message_retries[message_id] = retries
+    logger.warning(f"Mail {message_id} failed ({retries}/{MAX_MESSAGE_RETRIES}), retry on next poll: {error}")
+    return True
+
+
+def receive_mails(filter_read: bool, save_mail: Callable[[Mail], bool]) -> List[Mail]:
     """
     Receive mails from gmail and return a list of unread mails
+    1. list new message ids (history sync or full listing)
+    2. batch fetch the headers and keep mails with a valid subject
+    3. batch fetch the full format of the kept mails and save them with save_mail,
+    attachments are fetched on save
+    4. mark the saved mails as read, the history id is advanced when no mail is held
+    for a retry
     """
 
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
     service = get_gmail_service()
-    if filter_read:
-        gmail_results = (
-            service.users()
-            .messages()
-            .list(userId="me", labelIds=["INBOX"], q="is:unread")
-            .execute()
+    message_ids, history_id = None, None
+    start_history_id = load_history_id()
+    if start_history_id:
+        message_ids, history_id = list_history_message_ids(
+            service, start_history_id, filter_read
         )
-    else:
-        gmail_results = (
-            service.users().messages().list(userId="me", labelIds=["INBOX"]).execute()
-        )
-    message_ids = [x["id"] for x in gmail_results.get("messages", [])]
+    if message_ids is None:
+        history_id = service.users().getProfile(userId="me").execute()["historyId"]
+        message_ids = list_message_ids(service, filter_read)
     parsed_mails = []
     if not message_ids:
-        print("No messages found.")
+        logger.debug("No messages found.")
+        save_history_id(history_id)
+        return parsed_mails
+
+    metadata_messages, retry_ids = batch_execute(
+        service,
+        {
+            message_id: service.users()
+            .messages()
+            .get(
+                userId="me",
+                id=message_id,
+                format="metadata",
+                metadataHeaders=METADATA_HEADERS,
+                fields="id,labelIds,payload/headers",
+            )
+            for message_id in message_ids
+        },
+    )
+    # ids failed with a retryable error, the history id is not advanced so they are
+    # listed again by the next sync; permanent failures are logged and dropped
+    held_message_ids = [x for x in retry_ids if hold_message(x, "fetch metadata failed")]
+    valid_message_ids = []
+    for message_id in message_ids:
+        message = metadata_messages.get(message_id)
+        if message is None:
+            continue
+        if filter_read and "UNREAD" not in message.get("labelIds", []):
+            continue
+        try:
+            parse_subject(get_headers(message).get("Subject", ""))
+        except (ValueError, IndexError) as e:
+            logger.debug(f"Skip mail: {message_id}, {e}")
+            continue
+        valid_message_ids.append(message_id)
+
+    full_messages, retry_ids = batch_execute(
+        service,
+        {
+            message_id: service.users()
+            .messages()
+            .get(userId="me", id=message_id, format="full", fields="id,payload")
+            for message_id in valid_message_ids
+        },
+    )
+    held_message_ids += [x for x in retry_ids if hold_message(x, "fetch mail failed")]
+    read_message_ids = []
+    for message_id in valid_message_ids:
+        message = full_messages.get(message_id)
+        if message is None:
+            continue
+        try:
+            mail = parse_mail(service, message)
+        except Exception as e:
+            logger.error(f"Failed to parse mail: {message_id}, error: {e}")
+            continue
+        if mail.is_replied:
+            read_message_ids.append(message_id)
+        elif save_mail(mail):
+            _message_retries.pop(message_id, None)
+            read_message_ids.append(message_id)
+            parsed_mails.append(mail)
+        elif hold_message(message_id, "save mail failed"):
+            held_message_ids.append(message_id)
+    mark_mails_as_read(service, read_message_ids)
+    if held_message_ids:
+        logger.warning(
+            f"Keep gmail history id {start_history_id}, {len(held_message_ids)} mails held: {held_message_ids}"
+        )
     else:
-        for message_id in message_ids:
-            try:
-                mail = read_mail(service, message_id)
-                mark_mail_as_read(service, message_id)
-                if not mail.is_replied:
-                    parsed_mails.append(mail)
-            except Exception as e:
-                logger.error(f"Failed to parse mail: {message_id}, error: {e}")
+        save_history_id(history_id)
     return parsed_mails
 
 
@@ -204,3 +472,38 @@ def reply_mail(mail: Mail, content: str) -> bool:
 
     sent_message = service.users().messages().send(userId="me", body=msg_dict).execute()
     return sent_message
+
+
+def subscribe(notification_url: str, client_state: str) -> Subscription:
+    """watch the inbox and publish changes to the pub/sub topic
+    the push subscription of the topic forwards the notifications to notification_url
+    with the token query parameter, it is configured in the google cloud console
+    """
+    if not PUBSUB_TOPIC:
+        raise MailError("GMAIL_PUBSUB_TOPIC is not set")
+    if not env.MAIL_PUSH_TOKEN:
+        # pushes without the token are rejected by the intake
+        raise MailError("MAIL_PUSH_TOKEN is not set")
+    service = get_gmail_service()
+    response = (
+        service.users()
+        .watch(
+            userId="me",
+            body={
+                "topicName": PUBSUB_TOPIC,
+                "labelIds": ["INBOX"],
+                "labelFilterBehavior": "INCLUDE",
+            },
+        )
+        .execute()
+    )
+    # expiration: epoch milliseconds
+    expiration = datetime.datetime.fromtimestamp(
+        int(response["expiration"]) / 1000, tz=datetime.timezone.utc
+    )
+    return Subscription(id=PUBSUB_TOPIC, expiration=expiration)
+
+
+def renew_subscription(subscription: Subscription) -> Subscription:
+    """gmail renews the watch by calling watch again"""
+    return subscribe(None, None)
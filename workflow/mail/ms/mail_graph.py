@@ -1,10 +1,10 @@
 from loguru import logger
 import os
-import requests
 import json
-from typing import List, Optional
+import datetime
+from typing import Callable, List, Optional
 from ms.utils import parse_subject, parse_body
-from ms.data import Mail, Attachment, MailError
+from ms.data import Mail, Attachment, MailError, Subscription
 from ms.graph import ENV
 import env
 
@@ -18,18 +18,44 @@ mail_env = ENV(
 )
 logger.debug(f"TOKEN: {mail_env.token}")
 logger.debug(f"FOLDER_ID: {mail_env.folder_id}")
+# message subscriptions expire after at most 10080 minutes
+SUBSCRIPTION_MINUTES = int(os.getenv("MAIL_SUBSCRIPTION_MINUTES", 60))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
 
 
+def download_attachment(mail_id: str, attachment_id: str, save_path: str):
+    """stream the raw attachment content to a file through the /$value endpoint"""
+    url = f"{mail_env.base_url}/users/{mail_env.user_id}/messages/{mail_id}/attachments/{attachment_id}/$value"
+    with mail_env.request("GET", url, stream=True) as response:
+        if response.status_code != 200:
+            raise MailError(
+                f"Failed to download attachment: Response code:{response.status_code} - {response.text}"
+            )
+        with open(save_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+
 def get_attachments(mail_id: str) -> List[Attachment]:
-    """get attachments from a mail"""
-    url = f"{mail_env.base_url}/users/{mail_env.user_id}/messages/{mail_id}/attachments"
-    response = requests.request("GET", url, headers=mail_env.headers)
+    """get attachment metadata from a mail, the content is downloaded on save"""
+    url = f"{mail_env.base_url}/users/{mail_env.user_id}/messages/{mail_id}/attachments?$select=id,name,size,contentType"
+    response = mail_env.request("GET", url)
     if response.status_code != 200:
         raise MailError(
             f"Failed to get attachments: Response code:{response.status_code} - {json.dumps(response.json())}"
         )
-    attachments = [Attachment(**x) for x in response.json()["value"]]
+    attachments = []
+    for x in response.json()["value"]:
+        attachment = Attachment(
+            id=x["id"], name=x["name"], size=x["size"], contentType=x["contentType"]
+        )
+        attachment.set_downloader(
+            lambda save_path, attachment_id=x["id"]: download_attachment(
+                mail_id, attachment_id, save_path
+            )
+        )
+        attachments.append(attachment)
     return attachments
 
 
@@ -59,16 +85,13 @@ def parse_mail(raw_mail: dict) -> Optional[Mail]:
     return mail
 
 
-def receive_mails(filter_read: bool) -> List[Mail]:
+def receive_mails(filter_read: bool, save_mail: Callable[[Mail], bool]) -> List[Mail]:
     """
     Receive mails from a specific folder and return a list of unread mails
+    the mails are saved with save_mail, a mail that could not be saved is skipped
     """
     url = f"{mail_env.base_url}/users/{mail_env.user_id}/mailFolders/{mail_env.folder_id}/messages"
-    response = requests.request("GET", url, headers=mail_env.headers)
-    if response.status_code == 401:
-        mail_env.update_token()
-        url = f"{mail_env.base_url}/users/{mail_env.user_id}/mailFolders/{mail_env.folder_id}/messages"
-        response = requests.request("GET", url, headers=mail_env.headers)
+    response = mail_env.request("GET", url)
     if response.status_code != 200:
         raise MailError(
             f"Failed to get mails: Response code:{response.status_code} - {json.dumps(response.json())}"
@@ -92,7 +115,7 @@ def receive_mails(filter_read: bool) -> List[Mail]:
             continue
         try:
             parsed_mail = parse_mail(raw_mail)
-            if not parsed_mail.is_replied:
+            if not parsed_mail.is_replied and save_mail(parsed_mail):
                 parsed_mails.append(parsed_mail)
         except MailError as e:
             logger.error(f"Failed to parse mail: {raw_mail.get('id')}, error: {e}")
@@ -114,9 +137,7 @@ def reply_mail(mail: Mail, content: str) -> dict:
         "comment": content,
     }
 
-    response = requests.request(
-        "POST", url, headers=mail_env.headers, data=json.dumps(payload)
-    )
+    response = mail_env.request("POST", url, data=json.dumps(payload))
 
     if response.status_code != 202:
         raise MailError(
@@ -127,10 +148,61 @@ def reply_mail(mail: Mail, content: str) -> dict:
 
 def list_mail_folders() -> List[dict]:
     url = f"{mail_env.base_url}/users/{mail_env.user_id}/mailFolders/?includeHiddenFolders=true"
-    response = requests.request("GET", url, headers=mail_env.headers)
+    response = mail_env.request("GET", url)
     if response.status_code != 200:
         raise MailError(
             f"Failed to list mail folders: Response code:{response.status_code} - {json.dumps(response.json())}"
         )
 
     return response.json().get("value", [])
+
+
+def parse_subscription(raw_subscription: dict) -> Subscription:
+    """parse a subscription from the API"""
+    return Subscription(
+        id=raw_subscription["id"],
+        expiration=datetime.datetime.fromisoformat(
+            raw_subscription["expirationDateTime"].replace("Z", "+00:00")
+        ),
+    )
+
+
+def subscription_expiration() -> str:
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        minutes=SUBSCRIPTION_MINUTES
+    )
+    return expiration.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
+
+
+def subscribe(notification_url: str, client_state: str) -> Subscription:
+    """subscribe to new mails in the bot folder
+    graph validates the notification url before the subscription is created
+    """
+    url = f"{mail_env.base_url}/subscriptions"
+    payload = {
+        "changeType": "created",
+        "notificationUrl": notification_url,
+        # subscription removed / reauthorization required, handled by the intake
+        "lifecycleNotificationUrl": notification_url,
+        "resource": f"users/{mail_env.user_id}/mailFolders/{mail_env.folder_id}/messages",
+        "expirationDateTime": subscription_expiration(),
+        "clientState": client_state,
+    }
+    response = mail_env.request("POST", url, data=json.dumps(payload))
+    if response.status_code != 201:
+        raise MailError(
+            f"Failed to create subscription: Response code:{response.status_code} - {json.dumps(response.json())}"
+        )
+    return parse_subscription(response.json())
+
+
+def renew_subscription(subscription: Subscription) -> Subscription:
+    """extend the expiration of the subscription"""
+    url = f"{mail_env.base_url}/subscriptions/{subscription.id}"
+    payload = {"expirationDateTime": subscription_expiration()}
+    response = mail_env.request("PATCH", url, data=json.dumps(payload))
+    if response.status_code != 200:
+        raise MailError(
+            f"Failed to renew subscription: Response code:{response.status_code} - {json.dumps(response.json())}"
+        )
+    return parse_subscription(response.json())
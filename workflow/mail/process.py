@@ -7,11 +7,56 @@ from src.agents.data_summarizer.agent import init_graph as init_data_summarizer_
 from src.agents.chatbot.agent import init_graph as init_chatbot_graph
 from src.agents.web_search.agent import init_graph as init_web_search_graph
 import tempfile
+import time
+import datetime
+from email.utils import parsedate_to_datetime
 from ms import mail as mail_utils
 from utils import format_error_message, logger
 import markdown
+import metrics
 import env
 
+# graph node name -> metrics stage, other nodes are llm calls
+NODE_STAGES = {
+    "transcribe": "transcription",
+    "extract_data": "extraction",
+}
+
+
+def get_received_time(mail: mail_utils.Mail) -> float:
+    """received time of the mail as epoch seconds
+    graph: 2024-11-19T08:07:35Z, gmail: 19 Nov 2024 08:07:35 +0000
+    """
+    try:
+        received = datetime.datetime.fromisoformat(
+            mail.receivedDateTime.replace("Z", "+00:00")
+        )
+    except ValueError:
+        received = parsedate_to_datetime(mail.receivedDateTime)
+    return received.timestamp()
+
+
+def invoke_graph(graph, state: dict, thread_config: dict, assistant: str) -> dict:
+    """invoke the graph and record the time spent in each node"""
+    start = time.perf_counter()
+    for update in graph.stream(state, thread_config, stream_mode="updates"):
+        for node_name in update:
+            end = time.perf_counter()
+            metrics.STAGE_TIME.observe(
+                end - start,
+                assistant=assistant,
+                stage=NODE_STAGES.get(node_name, "llm"),
+            )
+            start = end
+    return graph.get_state(thread_config).values
+
+
+def reply_mail(mail: mail_utils.Mail, content: str):
+    with metrics.timer(
+        metrics.STAGE_TIME, assistant=mail_utils.get_assistant_label(mail), stage="reply"
+    ):
+        mail_utils.reply_mail(mail, content)
+
 
 def process_ask_chatbot_mail(mail: mail_utils.Mail):
 
@@ -19,14 +64,14 @@ def process_ask_chatbot_mail(mail: mail_utils.Mail):
     graph, _ = init_chatbot_graph(agent_config)
     state = {"messages": [{"role": "user", "content": mail.body}]}
     thread_config = {"configurable": {"thread_id": mail.id}}
-    state = graph.invoke(state, thread_config)
+    state = invoke_graph(graph, state, thread_config, mail_utils.get_assistant_label(mail))
     reply = state["messages"][-1].content
     try:
         reply = markdown.markdown(reply)
     except Exception as e:
         logger.error(f"process_ask_chatbot_mail failed to convert markdown: {reply}")
         reply = reply
-    mail_utils.reply_mail(mail, reply)
+    reply_mail(mail, reply)
 
 
 def process_tool_ms_mail(mail: mail_utils.Mail):
@@ -36,21 +81,18 @@ def process_tool_ms_mail(mail: mail_utils.Mail):
     thread_config = {"configurable": {"thread_id": mail.id}}
     file_path = None
     with tempfile.TemporaryDirectory() as temp_folder:
-        for attachment in mail.attachments:
+        for attachment in mail.attachments or []:
             extension = attachment.name.split(".")[-1]
             if extension.lower() in ["mp4", "mp3", "m4a", "wav"]:
-                temp_folder = tempfile.gettempdir()
-                temp_file_path = os.path.join(temp_folder, f"{mail.id}.{extension}")
-                with open(temp_file_path, "wb") as f:
-                    f.write(attachment.to_bytes())
-                file_path = temp_file_path
+                # the file saved with the mail by receive_mails, downloaded if missing
+                file_path = attachment.get_path(temp_folder)
                 break
         if file_path is None:
             raise Exception("No audio file found in the mail")
         state = {"messages": [], "file_path": file_path}
-        state = graph.invoke(state, thread_config)
+        state = invoke_graph(graph, state, thread_config, mail_utils.get_assistant_label(mail))
         reply = state["summary"]
-        mail_utils.reply_mail(mail, reply)
+        reply_mail(mail, reply)
 
 
 def process_tool_data_summarizer_mail(mail: mail_utils.Mail):
@@ -75,7 +117,7 @@ def process_tool_data_summarizer_mail(mail: mail_utils.Mail):
                     "xlsx",
                     "txt",
                 ]:
-                    save_path = attachment.save_to_file(temp_folder)
+                    save_path = attachment.get_path(temp_folder)
                     data_source_list.append(save_path)
         if mail.urls:
             for url in mail.urls:
@@ -89,13 +131,21 @@ def process_tool_data_summarizer_mail(mail: mail_utils.Mail):
             "format_instruction": "",
             "user_query": "",
         }
-        state = graph.invoke(state, thread_config)
+        state = invoke_graph(graph, state, thread_config, mail_utils.get_assistant_label(mail))
+        extract_errors = "".join(
+            f"- {x.data_source}: {x.error}\n" for x in state.get("extract_errors", [])
+        )
+        if state.get("extract_error", False):
+            reply_mail(mail, markdown.markdown(f"# EXTRACTION FAILED\n{extract_errors}"))
+            return
         reply = f"# DATA SUMMARY\n{state['summary_list'][0]}"
         user_query = mail.body.strip()
         if user_query != "":
             state["user_query"] = user_query
-            state = graph.invoke(state, thread_config)
+            state = invoke_graph(graph, state, thread_config, mail_utils.get_assistant_label(mail))
             reply += f"\n# USER QUERY\n{state['answer']}"
+        if extract_errors:
+            reply += f"\n# EXTRACTION ERRORS\n{extract_errors}"
         reply += f"\n# DATA CONTENT\n"
         for data_content in state["data_content_list"]:
             reply += f"{data_content.title}\n{data_content.content}\n"
@@ -106,7 +156,7 @@ def process_tool_data_summarizer_mail(mail: mail_utils.Mail):
                 f"process_tool_data_summarizer_mail failed to convert markdown: {reply}"
             )
             reply = reply
-        mail_utils.reply_mail(mail, reply)
+        reply_mail(mail, reply)
 
 
 def process_tool_web_search_mail(mail: mail_utils.Mail):
@@ -115,7 +165,7 @@ def process_tool_web_search_mail(mail: mail_utils.Mail):
     thread_config = {"configurable": {"thread_id": mail.id}}
     state = {"user_query": mail.body.strip(), "answer": ""}
     try:
-        state = graph.invoke(state, thread_config)
+        state = invoke_graph(graph, state, thread_config, mail_utils.get_assistant_label(mail))
     except Exception as e:
         logger.error(f"process_web_search_mail failed: {e}")
         reply = format_error_message(e)
@@ -126,39 +176,59 @@ def process_tool_web_search_mail(mail: mail_utils.Mail):
     except Exception as e:
         logger.error(f"process_web_search_mail failed to convert markdown: {reply}")
         reply = reply
-    mail_utils.reply_mail(mail, reply)
+    reply_mail(mail, reply)
 
 
 def process_mail(mail: mail_utils.Mail):
+    assistant_label = mail_utils.get_assistant_label(mail)
     try:
-        category = mail.category.replace("BotTest", "").upper()
-        assistant = mail.assistant.upper()
-        if category == "ASK":
-            if assistant == "CHATBOT":
-                process_ask_chatbot_mail(mail)
-            else:
-                raise Exception(f"Unknown assistant: {assistant}")
-        elif category == "TOOL":
-            if assistant == "MS":
-                process_tool_ms_mail(mail)
-            elif assistant == "DS":
-                process_tool_data_summarizer_mail(mail)
-            elif assistant == "WS":
-                process_tool_web_search_mail(mail)
-            elif assistant == "CHATBOT":
-                process_ask_chatbot_mail(mail)
-            else:
-                raise Exception(f"Unknown assistant: {assistant}")
-        else:
-            raise Exception(f"Unknown category: {category}")
+        metrics.TIME_IN_QUEUE.observe(
+            max(time.time() - get_received_time(mail), 0), assistant=assistant_label
+        )
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid received time: {mail.receivedDateTime}")
+    start = time.perf_counter()
+    try:
+        process_mail_by_assistant(mail)
     except Exception as e:
+        metrics.MAILS_PROCESSED.inc(assistant=assistant_label, status="failure")
         try:
-            mail_utils.reply_mail(mail, format_error_message(e))
+            reply_mail(mail, format_error_message(e))
         except Exception as e:
             logger.error(
                 f"process_mail_error[{mail.id}]: {format_error_message(e)}",
                 extra={"mail_id": mail.id},
             )
+    else:
+        metrics.MAILS_PROCESSED.inc(assistant=assistant_label, status="success")
+    finally:
+        metrics.PROCESSING_TIME.observe(
+            time.perf_counter() - start, assistant=assistant_label
+        )
+
+
+def process_mail_by_assistant(mail: mail_utils.Mail):
+    """route the mail to the assistant"""
+    category = mail.category.replace("BotTest", "").upper()
+    assistant = mail.assistant.upper()
+    if category == "ASK":
+        if assistant == "CHATBOT":
+            process_ask_chatbot_mail(mail)
+        else:
+            raise Exception(f"Unknown assistant: {assistant}")
+    elif category == "TOOL":
+        if assistant == "MS":
+            process_tool_ms_mail(mail)
+        elif assistant == "DS":
+            process_tool_data_summarizer_mail(mail)
+        elif assistant == "WS":
+            process_tool_web_search_mail(mail)
+        elif assistant == "CHATBOT":
+            process_ask_chatbot_mail(mail)
+        else:
+            raise Exception(f"Unknown assistant: {assistant}")
+    else:
+        raise Exception(f"Unknown category: {category}")
 
 
 def process_mail_debug(mail: mail_utils.Mail):
@@ -1,7 +1,14 @@
-from typing import List
+from typing import List, Optional
 import ms.mail as mail_utils
-from ms.data import Mail
+from ms.data import Mail, Subscription
 
 def receive_mails(filter_read:bool=True) -> List[Mail]:
     """receive mails from mailbox"""
     return mail_utils.receive_mails(filter_read=filter_read)
+
+
+def subscribe(
+    notification_url: str, client_state: str, subscription: Optional[Subscription] = None
+) -> Subscription:
+    """create or renew the mailbox change notification subscription"""
+    return mail_utils.subscribe(notification_url, client_state, subscription)
@@ -1,4 +1,7 @@
 from typing import TypedDict, Optional
+from collections import OrderedDict
+import hashlib
+import threading
 from loguru import logger
 import validators
 from urllib.parse import urlparse
@@ -11,9 +14,13 @@ import tempfile
 from src.llm.config import LLMConfig, LLMModelType
 from src.llm.lc import llm_factory, tools_factory
 from src.llm.config import LLMModelType
-from src.agents.data_summarizer.utils import extract_data, DataContent, DataType
+from src.agents.data_summarizer.utils import extract_data_list, DataContent, DataType, ExtractError
 from src.agents.data_summarizer.utils_stt import STTConfig
+from src.agents.data_summarizer.utils_map_reduce import MapReduceConfig, estimate_tokens, reduce_contents
+from src.agents.data_summarizer.utils_cache import ExtractCache, ExtractCacheConfig
 from src.retriever.parser import PARSERS
+from src.retriever.retriever import Retriever, RetrieverConfig
+from langchain_core.runnables import RunnableConfig
 from langchain_core.messages import (
     BaseMessage,
     ToolMessage,
@@ -77,6 +84,7 @@ class State(TypedDict):
     format_instruction: str = ""
     user_query: str = ""
     extract_error: bool = False
+    extract_errors: list[ExtractError]
 
 
 class TranslationConfig(BaseModel):
@@ -94,6 +102,23 @@ class AgentConfig(BaseModel):
     stt_config: Optional[STTConfig] = None
     input_translation: Optional[TranslationConfig] = None
     output_translation: Optional[TranslationConfig] = None
+    # content longer than the budget is summarized part by part first
+    map_reduce: MapReduceConfig = MapReduceConfig()
+    # data sources extracted at the same time
+    extract_max_workers: int = 4
+    # concurrent llm calls, match the parallelism of the llm server (OLLAMA_NUM_PARALLEL)
+    max_concurrency: int = 4
+    # answer questions from the top-k passages of an in-memory index instead of the full content
+    qa_retriever: Optional[RetrieverConfig] = None
+    # the index is only built for content over this many (estimated) tokens,
+    # shorter content is answered with a single prompt
+    qa_min_tokens: int = 6000
+    # threads whose index is kept in memory
+    qa_max_threads: int = 16
+    # max seconds per data source
+    extract_timeout: Optional[float] = 1800
+    # reuse extracted contents of the same source
+    extract_cache: Optional[ExtractCacheConfig] = None
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -114,10 +139,20 @@ class Agent:
 
         if agent_config.output_translation:
             self.output_translator = llm_factory(agent_config.output_translation.llm)
-
-    def translate(self, translator, text: str, language: str) -> str:
-        """translate the text"""
-        messages = [
+        self.extract_cache = None
+        if agent_config.extract_cache:
+            self.extract_cache = ExtractCache(agent_config.extract_cache)
+        # thread_id -> (content hash, retriever), least recently used first
+        self.qa_retrievers: OrderedDict[str, tuple[str, Retriever]] = OrderedDict()
+        self.qa_lock = threading.Lock()
+
+    @property
+    def batch_config(self) -> dict:
+        """limit the concurrent llm calls to the parallelism of the llm server"""
+        return {"max_concurrency": self.agent_config.max_concurrency}
+
+    def translation_messages(self, text: str, language: str) -> list[dict]:
+        return [
             {
                 "role": "system",
                 "content": "you are a professional translator please translate the text to {language} without giving any explanation.".format(
@@ -126,9 +161,20 @@ class Agent:
             },
             {"role": "user", "content": text},
         ]
-        response = translator.invoke(messages)
+
+    def translate(self, translator, text: str, language: str) -> str:
+        """translate the text"""
+        response = translator.invoke(self.translation_messages(text, language))
         return response.content
 
+    def translate_batch(self, translator, texts: list[str], language: str) -> list[str]:
+        """translate the texts concurrently, results keep the input order"""
+        responses = translator.batch(
+            [self.translation_messages(text, language) for text in texts],
+            config=self.batch_config,
+        )
+        return [response.content for response in responses]
+
     def insert_system_prompt(self, messages: list[BaseMessage]):
         """insert the system prompt"""
         # if first message is not system, insert it
@@ -154,20 +200,21 @@ class Agent:
         data_source_list = state.get("data_source_list", None)
         if data_source_list is None:
             raise ValueError("Data source list is None")
-        data_content_list = []
-        for data_source in data_source_list:
-            data_content = extract_data(data_source, stt_config=self.agent_config.stt_config)
-            if data_content is None:
-                logger.error(f"Failed to extract data {data_source}")
-                state["extract_error"] = True
-                return state
-            data_content_list.append(data_content)
+        data_content_list, extract_errors = extract_data_list(
+            data_source_list,
+            max_workers=self.agent_config.extract_max_workers,
+            timeout=self.agent_config.extract_timeout,
+            cache=self.extract_cache,
+            stt_config=self.agent_config.stt_config,
+        )
+        state["extract_errors"] = extract_errors
         all_content = "\n".join(
             [data_content.content for data_content in data_content_list]
         ).strip()
         if all_content == "":
             state["extract_error"] = True
             return state
+        state["extract_error"] = False
         state["data_content_list"] = data_content_list
         return state
 
@@ -178,47 +225,88 @@ class Agent:
 
         if data_content_list is None:
             raise ValueError("Data content list is None")
-        summary_list = []
         format_instruction = state.get("format_instruction", "")
         if format_instruction == "":
             format_instruction = DEFAULT_SUMMARY_FORMAT
-        for data_content in data_content_list:
-            content = data_content.content
+        # long contents of all documents are mapped in the same batches
+        contents = reduce_contents(
+            self.llm,
+            [
+                (x.content, "transcript" if x.data_type == DataType.MEDIA else "document")
+                for x in data_content_list
+            ],
+            format_instruction,
+            self.agent_config.map_reduce,
+            self.batch_config,
+        )
+        messages_list = []
+        for data_content, content in zip(data_content_list, contents):
             if data_content.data_type == DataType.MEDIA:
                 user_prompt = DEFAULT_VIDEO_SUMMARY_PROMPT.format(
                     transcription=content, format=format_instruction
                 )
-                messages = [
-                    HumanMessage(content=user_prompt),
-                ]
             else:  # file or url
                 user_prompt = DEFAULT_SUMMARY_PROMPT.format(
                     content=content, format=format_instruction
                 )
-                messages = [
-                    HumanMessage(content=user_prompt),
-                ]
-
-            response = self.llm.invoke(messages)
-            summary = response.content
-            if self.output_translator:
-                logger.debug(
-                    f"[DATA_summarizer-SUMMARIZE] translate summary: {summary}"
-                )
-                summary = self.translate(
-                    self.output_translator,
-                    summary,
-                    self.agent_config.output_translation.language,
-                )
-            summary_list.append(summary)
+            messages_list.append([HumanMessage(content=user_prompt)])
+
+        # documents are summarized concurrently, batch keeps the input order
+        responses = self.llm.batch(messages_list, config=self.batch_config)
+        summary_list = [response.content for response in responses]
+        if self.output_translator:
+            logger.debug(
+                f"[DATA_summarizer-SUMMARIZE] translate summaries: {summary_list}"
+            )
+            summary_list = self.translate_batch(
+                self.output_translator,
+                summary_list,
+                self.agent_config.output_translation.language,
+            )
         state["summary_list"] = summary_list
         state["format_instruction"] = ""
         return state
 
-    def node_generate_answer(self, state: State, **kwargs):
-        """generate answer from the summary"""
-        logger.debug(f"[DATA_summarizer-GENERATE_ANSWER]-state: {state}")
-        data_content_list = state["data_content_list"]
+    def get_qa_retriever(self, thread_id: str, data_content_list: list[DataContent]) -> Retriever:
+        """in-memory index of the data contents, built once per thread and contents"""
+        content_hash = hashlib.sha256(
+            "\0".join(x.title + "\0" + x.content for x in data_content_list).encode("utf-8")
+        ).hexdigest()
+        with self.qa_lock:
+            if thread_id in self.qa_retrievers:
+                cached_hash, retriever = self.qa_retrievers[thread_id]
+                if cached_hash == content_hash:
+                    self.qa_retrievers.move_to_end(thread_id)
+                    return retriever
+        retriever = Retriever(retriever_config=self.agent_config.qa_retriever)
+        retriever.insert_texts(
+            [x.content for x in data_content_list],
+            [
+                {"title": x.title, "data_type": x.data_type.value}
+                for x in data_content_list
+            ],
+        )
+        logger.debug(f"[DATA_summarizer-GENERATE_ANSWER] index built for thread {thread_id}")
+        with self.qa_lock:
+            self.qa_retrievers[thread_id] = (content_hash, retriever)
+            self.qa_retrievers.move_to_end(thread_id)
+            while len(self.qa_retrievers) > self.agent_config.qa_max_threads:
+                self.qa_retrievers.popitem(last=False)
+        return retriever
+
+    def retrieve_content(self, thread_id: str, data_content_list: list[DataContent], user_query: str) -> str:
+        """top-k passages of the data contents for the question"""
+        retriever = self.get_qa_retriever(thread_id, data_content_list)
+        passages = []
+        for doc in retriever.retrieve_data(user_query):
+            header = doc.metadata.get("title", "")
+            if doc.metadata.get("data_type") == DataType.MEDIA.value:
+                header += " (transcription)"
+            passages.append(f"[{header}]\n{doc.page_content}")
+        return "\n\n".join(passages)
+
+    def extract_content(self, data_content_list: list[DataContent], user_query: str) -> str:
+        """relevant content of the full data contents for the question"""
         content = ""
         for data_content in data_content_list:
             if data_content.data_type == DataType.MEDIA:
@@ -232,12 +320,28 @@ class Agent:
         messages = [
             HumanMessage(
                 content=EXTRACT_CONTENT_PROMPT.format(
-                    content=content, question=state["user_query"]
+                    content=content, question=user_query
                 )
             ),
         ]
         response = self.llm.invoke(messages)
-        content = response.content
+        return response.content
+
+    def node_generate_answer(self, state: State, config: RunnableConfig):
+        """generate answer from the summary"""
+        logger.debug(f"[DATA_summarizer-GENERATE_ANSWER]-state: {state}")
+        data_content_list = state["data_content_list"]
+        content_tokens = sum(estimate_tokens(x.content) for x in data_content_list)
+        if (
+            self.agent_config.qa_retriever is not None
+            and content_tokens > self.agent_config.qa_min_tokens
+        ):
+            thread_id = config.get("configurable", {}).get("thread_id", "default")
+            content = self.retrieve_content(
+                thread_id, data_content_list, state["user_query"]
+            )
+        else:
+            content = self.extract_content(data_content_list, state["user_query"])
         logger.debug(f"[DATA_summarizer-GENERATE_ANSWER]-Relevant content: {content}")
 
         system_prompt = DEFAULT_ANSWER_PROMPT.format(content=content)
@@ -262,6 +366,12 @@ class Agent:
         state["user_query"] = ""
         return state
 
+    def route_extract(self, state: State, **kwargs):
+        """summarize when at least one data source is extracted"""
+        if state.get("extract_error", False):
+            return END
+        return "summarize"
+
     def route(self, state: State, **kwargs):
         """route the messages"""
         logger.debug(f"[DATA_summarizer-ROUTE]-state: {state}")
@@ -298,7 +408,11 @@ def init_graph(
         },
     )
 
-    builder.add_edge("extract_data", "summarize")
+    builder.add_conditional_edges(
+        "extract_data",
+        agent.route_extract,
+        {"summarize": "summarize", END: END},
+    )
     builder.add_edge("summarize", END)
     builder.add_edge("generate_answer", END)
 
@@ -1,14 +1,17 @@
 from pydantic import BaseModel
 from enum import Enum
 from urllib.parse import urlparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import os
 import tempfile
+import time
 import validators
 from src.agents.data_summarizer import utils_yt
 from src.agents.data_summarizer import utils_sharepoint
 from src.agents.data_summarizer import utils_google_drive
 from src.retriever.parser import PARSERS
-from typing import Optional
+from src.retriever.parse_engine import iter_documents
+from typing import List, Optional, Tuple
 from src.agents.data_summarizer import utils_stt
 from src.agents.data_summarizer import utils_download
 from loguru import logger
@@ -37,12 +40,24 @@ def is_valid_domain(url: str, domain: str) -> bool:
         return False
 
 
+def get_source_type(data_source: str) -> str:
+    """youtube, sharepoint, google_drive, url or file"""
+    if validators.url(data_source):
+        if is_valid_domain(data_source, "youtube.com"):
+            return "youtube"
+        if is_valid_domain(data_source, "sharepoint.com") or is_valid_domain(data_source, "onedrive.com"):
+            return "sharepoint"
+        if is_valid_domain(data_source, "drive.google.com") or is_valid_domain(data_source, "docs.google.com"):
+            return "google_drive"
+        return "url"
+    return "file"
+
+
 def parse_data(data_path: str, file_extension: str) -> str:
     """parse data using parsers"""
     if file_extension not in PARSERS:
         raise ValueError(f"File extension {file_extension} is not supported")
-    loader = PARSERS[file_extension](data_path)
-    docs = loader.load()
+    docs = iter_documents(data_path, file_extension)
     return "\n".join([doc.page_content for doc in docs])
 
 
@@ -62,22 +77,22 @@ def extract_data(data_source: str, **kwargs) -> DataContent:
 
     stt_config = kwargs.get("stt_config", None)
 
+    source_type = get_source_type(data_source)
     with tempfile.TemporaryDirectory() as temp_dir:
-        if validators.url(data_source):
-            if is_valid_domain(data_source, "youtube.com"):
-                content = utils_yt.extract_youtube_transcript(data_source, stt_config)
-                title = utils_yt.get_yt_title(data_source)
+        if source_type != "file":
+            if source_type == "youtube":
+                title, content = utils_yt.extract_youtube(data_source, stt_config)
                 return DataContent(
                     title=title, content=content, data_type=DataType.MEDIA
                 )
-            elif is_valid_domain(data_source, "sharepoint.com") or is_valid_domain(data_source, "onedrive.com"):
+            elif source_type == "sharepoint":
                 # TODO: add support for folder download
                 file_path_list = utils_sharepoint.download_sharepoint_data(data_source, temp_dir)
                 file_path_list = [x for x in file_path_list if os.path.basename(x).split(".")[-1] in supported_file_extensions]
                 if len(file_path_list) == 0:
                     raise ValueError(f"No file found in {data_source}")
                 data_path = file_path_list[0]
-            elif is_valid_domain(data_source, "drive.google.com") or is_valid_domain(data_source, "docs.google.com"):
+            elif source_type == "google_drive":
                 data_path = utils_google_drive.download_google_drive_data(data_source, temp_dir)
             else:
                 # download the data
@@ -99,3 +114,72 @@ def extract_data(data_source: str, **kwargs) -> DataContent:
             title = os.path.basename(data_path)
             data_type = DataType.FILE
         return DataContent(title=title, content=content, data_type=data_type)
+
+
+class ExtractError(BaseModel):
+    data_source: str
+    error: str
+
+
+def extract_data_list(
+    data_source_list: List[str],
+    max_workers: int = 4,
+    timeout: Optional[float] = None,
+    cache=None,
+    **kwargs,
+) -> Tuple[List[DataContent], List[ExtractError]]:
+    """extract the data sources in parallel, a failed source does not stop the others
+    ARGS:
+        data_source_list: urls or file paths
+        max_workers: max sources extracted at the same time
+        timeout: max seconds per source, counted from the start of its extraction
+        cache: ExtractCache, extracted contents are reused while valid
+        **kwargs: arguments of extract_data
+    RETURNS:
+        the data contents in the order of the sources, the errors of the failed sources
+    """
+    started_at = {}
+
+    def extract(idx: int, data_source: str) -> DataContent:
+        started_at[idx] = time.monotonic()
+        if cache is not None:
+            return cache.get_or_extract(
+                data_source, lambda: extract_data(data_source, **kwargs)
+            )
+        return extract_data(data_source, **kwargs)
+
+    results, errors = {}, {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {
+        executor.submit(extract, idx, data_source): idx
+        for idx, data_source in enumerate(data_source_list)
+    }
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = futures[future]
+                try:
+                    results[idx] = future.result()
+                except Exception as e:
+                    logger.error(f"Failed to extract data {data_source_list[idx]}: {e}")
+                    errors[idx] = str(e) or type(e).__name__
+            if timeout is None:
+                continue
+            now = time.monotonic()
+            for future in list(pending):
+                idx = futures[future]
+                if idx in started_at and now - started_at[idx] > timeout:
+                    # the thread can not be stopped, its result is dropped
+                    logger.error(f"Extract data {data_source_list[idx]} timeout after {timeout}s")
+                    errors[idx] = f"timeout after {timeout}s"
+                    pending.discard(future)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    data_content_list = [results[idx] for idx in sorted(results)]
+    extract_errors = [
+        ExtractError(data_source=data_source_list[idx], error=errors[idx])
+        for idx in sorted(errors)
+    ]
+    return data_content_list, extract_errors
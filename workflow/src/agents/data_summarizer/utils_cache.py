@@ -0,0 +1,192 @@
+"""Persistent cache of extracted data contents
+
+Entries are keyed by the source identity: the file hash for local files, the url otherwise.
+An entry is fresh for the ttl of its source type, a stale url entry is revalidated with a
+HEAD request (If-None-Match / If-Modified-Since) before it is extracted again.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import requests
+from loguru import logger
+from pydantic import BaseModel
+
+from src.agents.data_summarizer.utils import DataContent, get_source_type
+from src.agents.data_summarizer.utils_download import SESSION
+from src.retriever.parse_cache import hash_file
+
+# source types revalidated with a HEAD request when stale
+REVALIDATE_SOURCE_TYPES = ["url", "google_drive"]
+REVALIDATE_TIMEOUT = 10
+
+
+class ExtractCacheConfig(BaseModel):
+    """extracted content cache config"""
+
+    enable: bool = True
+    cache_folder: str
+    # seconds an entry is used without revalidation, per source type
+    ttl: Dict[str, int] = {
+        "file": 30 * 24 * 3600,  # keyed by content hash
+        "youtube": 7 * 24 * 3600,
+        "sharepoint": 3600,
+        "google_drive": 3600,
+        "url": 3600,
+    }
+    # stale entries older than this are removed
+    max_age: int = 30 * 24 * 3600
+
+
+class CacheEntry(BaseModel):
+    key: str
+    source_type: str
+    validated_at: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    data_content: DataContent
+
+
+def head(url: str, entry: Optional[CacheEntry] = None) -> Optional[requests.Response]:
+    """HEAD the url, conditional on the validators of the entry"""
+    headers = {}
+    if entry is not None and entry.etag:
+        headers["If-None-Match"] = entry.etag
+    if entry is not None and entry.last_modified:
+        headers["If-Modified-Since"] = entry.last_modified
+    try:
+        return SESSION.head(
+            url, headers=headers, allow_redirects=True, timeout=REVALIDATE_TIMEOUT
+        )
+    except requests.RequestException as e:
+        logger.warning(f"[EXTRACT_CACHE] HEAD {url} failed: {e}")
+        return None
+
+
+class ExtractCache:
+    """cache of DataContent on disk, one json file per source"""
+
+    def __init__(self, config: ExtractCacheConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        os.makedirs(config.cache_folder, exist_ok=True)
+
+    def get_key(self, data_source: str, source_type: str) -> str:
+        if source_type == "file":
+            return f"file:{hash_file(data_source)}"
+        return f"{source_type}:{data_source}"
+
+    def get_path(self, key: str) -> str:
+        file_name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.config.cache_folder, f"{file_name}.json")
+
+    def load(self, key: str) -> Optional[CacheEntry]:
+        try:
+            with open(self.get_path(key), "r") as f:
+                return CacheEntry(**json.load(f))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning(f"[EXTRACT_CACHE] invalid entry removed: {key}")
+            self.remove(key)
+            return None
+
+    def save(self, entry: CacheEntry):
+        path = self.get_path(entry.key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(entry.json())
+        os.replace(temp_path, path)
+
+    def remove(self, key: str):
+        try:
+            os.remove(self.get_path(key))
+        except FileNotFoundError:
+            pass
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        ttl = self.config.ttl.get(entry.source_type, 0)
+        return time.time() - entry.validated_at < ttl
+
+    def revalidate(self, entry: CacheEntry, data_source: str) -> bool:
+        """True when the source has not changed since the entry was extracted"""
+        if entry.source_type not in REVALIDATE_SOURCE_TYPES:
+            return False
+        if not entry.etag and not entry.last_modified:
+            return False
+        response = head(data_source, entry)
+        if response is None:
+            return False
+        if response.status_code == 304:
+            return True
+        if not response.ok:
+            return False
+        # servers often answer HEAD with 200, compare the validators
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if entry.etag and etag:
+            return etag == entry.etag
+        return bool(entry.last_modified) and last_modified == entry.last_modified
+
+    def stamp(self, data_content: DataContent, data_source: str, source_type: str) -> DataContent:
+        """file entries are shared by files with the same content, the title comes from the current file"""
+        if source_type == "file":
+            return data_content.copy(update={"title": os.path.basename(data_source)})
+        return data_content
+
+    def get_or_extract(self, data_source: str, extract: Callable[[], DataContent]) -> DataContent:
+        """return the cached content of the source, extract and cache it when missing or changed"""
+        if not self.config.enable:
+            return extract()
+        source_type = get_source_type(data_source)
+        key = self.get_key(data_source, source_type)
+        entry = self.load(key)
+        if entry is not None:
+            if self.is_fresh(entry):
+                logger.debug(f"[EXTRACT_CACHE] hit: {data_source}")
+                return self.stamp(entry.data_content, data_source, source_type)
+            if self.revalidate(entry, data_source):
+                logger.debug(f"[EXTRACT_CACHE] revalidated: {data_source}")
+                entry.validated_at = time.time()
+                self.save(entry)
+                return self.stamp(entry.data_content, data_source, source_type)
+        logger.debug(f"[EXTRACT_CACHE] miss: {data_source}")
+        etag, last_modified = None, None
+        if source_type in REVALIDATE_SOURCE_TYPES:
+            # validators are read before the download, a change in between is caught next time
+            response = head(data_source)
+            if response is not None and response.ok:
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        data_content = extract()
+        if not data_content.content.strip():
+            # a failed parse is extracted again next time
+            logger.warning(f"[EXTRACT_CACHE] empty content not cached: {data_source}")
+            return data_content
+        self.save(
+            CacheEntry(
+                key=key,
+                source_type=source_type,
+                validated_at=time.time(),
+                etag=etag,
+                last_modified=last_modified,
+                data_content=data_content,
+            )
+        )
+        self.cleanup()
+        return data_content
+
+    def cleanup(self):
+        """remove entries older than max_age"""
+        now = time.time()
+        with self.lock:
+            for entry in os.scandir(self.config.cache_folder):
+                if entry.name.endswith(".json") and now - entry.stat().st_mtime > self.config.max_age:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
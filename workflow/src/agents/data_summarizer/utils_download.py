@@ -1,54 +1,226 @@
+import codecs
 import requests
 import os
+import zipfile
+from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from loguru import logger
 
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36"
+}
+# (connect, read) timeout in seconds
+TIMEOUT = (10, 60)
+CHUNK_SIZE = 1024 * 1024
+MAX_DOWNLOAD_SIZE = 2 * 1024 * 1024 * 1024
+# times an interrupted download is resumed with a range request
+MAX_RESUMES = 3
+# bytes read to sniff the content type
+SNIFF_SIZE = 2048
 
-def download_data(url: str, save_folder: str) -> str:
+MIME_EXTENSIONS = {
+    "application/msword": "docx",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    "application/vnd.ms-excel": "xlsx",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
+    "application/vnd.ms-powerpoint": "pptx",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": "pptx",
+    "text/plain": "txt",
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/mp4": "m4a",
+    "audio/x-m4a": "m4a",
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/aac": "aac",
+    "video/mp4": "mp4",
+}
+
+
+def create_session() -> requests.Session:
+    """session with a connection pool, failed connections are retried"""
+    session = requests.Session()
+    retry = Retry(total=3, connect=3, read=0, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=["HEAD", "GET"])
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(HEADERS)
+    return session
+
+
+SESSION = create_session()
+
+
+def get_mime_type(response: Optional[requests.Response]) -> Optional[str]:
+    if response is None or "Content-Type" not in response.headers:
+        return None
+    return response.headers["Content-Type"].split(";")[0].strip().lower()
+
+
+def get_charset(response: Optional[requests.Response]) -> Optional[str]:
+    """charset declared in the Content-Type header"""
+    if response is None:
+        return None
+    for param in response.headers.get("Content-Type", "").split(";")[1:]:
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "charset" and value:
+            return value.strip('"').lower()
+    return None
+
+
+def mime_to_extension(mime_type: str) -> str:
+    if mime_type in MIME_EXTENSIONS:
+        return MIME_EXTENSIONS[mime_type]
+    return mime_type.split("/")[-1]
+
+
+def is_text_mime(mime_type: str) -> bool:
+    return "text" in mime_type or mime_type in ["application/json", "application/xml"]
+
+
+def sniff_extension(file_path: str) -> Optional[str]:
+    """guess the file extension from the first bytes"""
+    with open(file_path, "rb") as f:
+        head = f.read(SNIFF_SIZE)
+    text = head.lstrip().lower()
+    if head.startswith(b"%PDF"):
+        return "pdf"
+    if head.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(file_path) as zip_file:
+                names = zip_file.namelist()
+        except zipfile.BadZipFile:
+            return None
+        for prefix, extension in [("word/", "docx"), ("xl/", "xlsx"), ("ppt/", "pptx")]:
+            if any(name.startswith(prefix) for name in names):
+                return extension
+        return None
+    if head.startswith(b"ID3") or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "mp3"
+    if head[4:8] == b"ftyp":
+        return "m4a" if head[8:11] == b"M4A" else "mp4"
+    if head.startswith(b"RIFF") and head[8:12] == b"WAVE":
+        return "wav"
+    if head[:2] in (b"\xff\xf1", b"\xff\xf9"):
+        return "aac"
+    if head.startswith(b"\x89PNG"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpg"
+    if text.startswith(b"<!doctype html") or text.startswith(b"<html"):
+        return "html"
+    if text.startswith(b"<?xml"):
+        return "xml"
+    if text[:1] in (b"{", b"["):
+        return "json"
+    return None
+
+
+def head_url(url: str) -> Optional[requests.Response]:
+    """HEAD the url, None when the server does not support it"""
+    try:
+        response = SESSION.head(url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        logger.debug(f"HEAD {url} failed: {e}")
+        return None
+    if not response.ok:
+        logger.debug(f"HEAD {url} status {response.status_code}")
+        return None
+    return response
+
+
+def check_size(size: Optional[str], max_size: int):
+    if size is not None and size.isdigit() and int(size) > max_size:
+        raise ValueError(f"Download exceeds {max_size // (1024 * 1024)} MB")
+
+
+def stream_to_file(url: str, file_path: str, max_size: int) -> requests.Response:
+    """download url to file_path chunk by chunk
+    an interrupted download is resumed with a range request when the server accepts ranges
+    returns the response of the first request
+    """
+    first_response = None
+    written = 0
+    resumes = 0
+    with open(file_path, "wb") as f:
+        while True:
+            headers = {"Range": f"bytes={written}-"} if written > 0 else {}
+            try:
+                with SESSION.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                    response.raise_for_status()
+                    if first_response is None:
+                        first_response = response
+                        check_size(response.headers.get("Content-Length"), max_size)
+                    if written > 0 and response.status_code != 206:
+                        # range ignored, start over
+                        f.seek(0)
+                        f.truncate()
+                        written = 0
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        written += len(chunk)
+                        if written > max_size:
+                            raise ValueError(f"Download exceeds {max_size // (1024 * 1024)} MB")
+                        f.write(chunk)
+                return first_response
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.RetryError,
+            ) as e:
+                accept_ranges = first_response is not None and first_response.headers.get("Accept-Ranges", "").lower() == "bytes"
+                if not accept_ranges or written == 0 or resumes >= MAX_RESUMES:
+                    raise
+                resumes += 1
+                logger.warning(f"Download interrupted at {written} bytes, resume ({resumes}/{MAX_RESUMES}): {e}")
+
+
+def download_data(url: str, save_folder: str, max_size: int = MAX_DOWNLOAD_SIZE) -> str:
     """download data from url and save to save_folder
+    the body is streamed to disk, the content type comes from HEAD, the GET response or the first bytes
     args:
         url: the url of the data
         save_folder: the folder to save the data
+        max_size: max download size in bytes
     returns:
         the path of the saved data
     """
     os.makedirs(save_folder, exist_ok=True)
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36"
-    }
     logger.debug(f"Downloading data from {url}")
-    response = requests.head(url, headers=headers)
-    response.raise_for_status()
-    mime_type = response.headers["Content-Type"].split(";")[0]
+    head_response = head_url(url)
+    if head_response is not None:
+        check_size(head_response.headers.get("Content-Length"), max_size)
+    temp_path = os.path.join(save_folder, "data.part")
+    try:
+        get_response = stream_to_file(url, temp_path, max_size)
+    except requests.RequestException as e:
+        # includes RetryError once the retries of the session are exhausted
+        raise ValueError(f"Failed to download {url}: {e}") from e
+    mime_type = get_mime_type(head_response) or get_mime_type(get_response)
     logger.debug(f"Mime type: {mime_type}")
 
-    # mine_type is text/html or json or xml
-    if "text" in mime_type or mime_type in ["application/json", "application/xml"]:
-        file_extension = mime_type.split("/")[-1]
-        response = requests.get(url, headers=headers)
-        save_path = os.path.join(save_folder, f"data.{file_extension}")
-        with open(save_path, "w") as f:
-            f.write(response.text)
+    if mime_type is None or mime_type in ["application/octet-stream", "binary/octet-stream"]:
+        file_extension = sniff_extension(temp_path)
+        if file_extension is None:
+            raise ValueError(f"Unknown content type of {url}")
+    else:
+        file_extension = mime_to_extension(mime_type)
+    save_path = os.path.join(save_folder, f"data.{file_extension}")
+    charset = get_charset(head_response) or get_charset(get_response)
+    if charset is not None:
+        try:
+            charset = codecs.lookup(charset).name
+        except LookupError:
+            logger.warning(f"Unknown charset {charset}, decode as utf-8")
+            charset = "utf-8"
+    if mime_type is not None and is_text_mime(mime_type) and charset not in (None, "utf-8"):
+        # text is saved as utf-8 for the parsers
+        with open(temp_path, "rb") as f:
+            text = f.read().decode(charset, errors="replace")
+        with open(save_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.remove(temp_path)
     else:
-        if mime_type in [
-            "application/msword",
-            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        ]:
-            file_extension = "docx"
-        elif mime_type in [
-            "application/vnd.ms-excel",
-            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        ]:
-            file_extension = "xlsx"
-        elif mime_type in [
-            "application/vnd.ms-powerpoint",
-            "application/vnd.openxmlformats-officedocument.presentationml.presentation",
-        ]:
-            file_extension = "pptx"
-        else:
-            file_extension = mime_type.split("/")[-1]
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        save_path = os.path.join(save_folder, f"data.{file_extension}")
-        with open(save_path, "wb") as f:
-            f.write(response.content)
+        os.replace(temp_path, save_path)
     return save_path
@@ -0,0 +1,146 @@
+"""Map-reduce summarization for content longer than the prompt budget"""
+
+import math
+import re
+from typing import List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+from langchain_core.messages import HumanMessage
+
+from src.retriever.parser import splitter_factory
+
+# CJK ideographs, kana and hangul are about one token per character
+CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+MAP_PROMPT = """
+The following content is part {index} of {total} of a longer {kind}, wrapped in the <content> tag.
+<content>
+{content}
+</content>
+The parts will be combined into a final summary with the following requirements:
+{format}
+Summarize this part in detail: keep the key points, facts, numbers, names and conclusions, in the original order.
+Do not add content outside this part.
+"""
+
+COMBINE_PROMPT = """
+The following are summaries of consecutive parts of a longer {kind}, wrapped in the <summaries> tag.
+<summaries>
+{content}
+</summaries>
+The result will be summarized with the following requirements:
+{format}
+Merge the summaries into one detailed summary: keep the key points, facts, numbers, names and conclusions, in the original order, and remove repetitions.
+Do not add content outside the summaries.
+"""
+
+
+class MapReduceConfig(BaseModel):
+    """map-reduce summarization config"""
+
+    enable: bool = True
+    # estimated tokens of content in one prompt
+    max_tokens: int = 6000
+    chunk_overlap: int = 200
+    # max rounds of combining summaries after the map round
+    max_depth: int = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """estimate the number of tokens without a tokenizer
+    CJK characters count as one token, other characters as a quarter token
+    """
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def split_text(text: str, max_tokens: int, chunk_overlap: int) -> List[str]:
+    splitter = splitter_factory(max_tokens, chunk_overlap, estimate_tokens)
+    return splitter.split_text(text)
+
+
+def part_messages(prompt: str, parts: List[str], kind: str, format_instruction: str) -> List[list]:
+    """prompt of each part"""
+    return [
+        [
+            HumanMessage(
+                content=prompt.format(
+                    index=idx + 1,
+                    total=len(parts),
+                    kind=kind,
+                    content=part,
+                    format=format_instruction,
+                )
+            )
+        ]
+        for idx, part in enumerate(parts)
+    ]
+
+
+def reduce_contents(
+    llm,
+    contents: List[Tuple[str, str]],
+    format_instruction: str,
+    config: Optional[MapReduceConfig] = None,
+    batch_config: Optional[dict] = None,
+) -> List[str]:
+    """shrink the contents that do not fit in one prompt
+    each content is split by token budget and the parts are summarized (map), the summaries
+    are merged group by group until they fit (reduce). In every round the parts of all
+    contents go through a single llm.batch call, so documents are mapped in parallel too.
+    contents that fit are returned as is
+    Args:
+        llm: langchain chat model
+        contents: (content, kind) of each document, kind is used in the prompts, e.g. document, transcript
+        format_instruction: requirements of the final summary, guides what the parts keep
+        config: map-reduce config
+        batch_config: config of llm.batch, e.g. {"max_concurrency": 4}
+    Returns:
+        list: content or merged summaries that fit in config.max_tokens, in the input order
+    """
+    config = config or MapReduceConfig()
+    results = [content for content, _ in contents]
+    if not config.enable:
+        return results
+    kinds = [kind for _, kind in contents]
+    pending = [idx for idx, content in enumerate(results) if estimate_tokens(content) > config.max_tokens]
+    prompt = MAP_PROMPT
+    # depth 0 maps the parts, depth 1..max_depth combine the summaries
+    for depth in range(config.max_depth + 1):
+        if not pending:
+            break
+        messages, owners = [], []
+        for idx in pending:
+            parts = split_text(results[idx], config.max_tokens, config.chunk_overlap)
+            logger.debug(
+                f"[MAP_REDUCE] depth {depth}, content {idx}: {len(parts)} parts, {estimate_tokens(results[idx])} tokens"
+            )
+            messages.extend(part_messages(prompt, parts, kinds[idx], format_instruction))
+            owners.extend([idx] * len(parts))
+        responses = llm.batch(messages, config=batch_config)
+        summaries = {idx: [] for idx in pending}
+        for idx, response in zip(owners, responses):
+            summaries[idx].append(response.content)
+        for idx in pending:
+            results[idx] = "\n\n".join(summaries[idx])
+        # later rounds merge summaries
+        prompt = COMBINE_PROMPT
+        pending = [idx for idx in pending if estimate_tokens(results[idx]) > config.max_tokens]
+    for idx in pending:
+        logger.warning(
+            f"[MAP_REDUCE] content {idx} still {estimate_tokens(results[idx])} tokens after {config.max_depth} combine rounds"
+        )
+    return results
+
+
+def reduce_content(
+    llm,
+    content: str,
+    format_instruction: str,
+    config: Optional[MapReduceConfig] = None,
+    kind: str = "document",
+    batch_config: Optional[dict] = None,
+) -> str:
+    """shrink a single content, see reduce_contents"""
+    return reduce_contents(llm, [(content, kind)], format_instruction, config, batch_config)[0]
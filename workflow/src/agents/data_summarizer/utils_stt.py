@@ -1,5 +1,8 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import BinaryIO, Iterable, Iterator, Optional, Union
+import json
+import os
+import time
 
 import requests
 import opencc
@@ -12,6 +15,20 @@ class STTConfig(BaseModel):
     model: str = "whisper"
     provider: str = "custom"
     api_key: Optional[str] = None
+    # language of the audio (zh, en), None lets the service detect it
+    language: Optional[str] = None
+    # seconds between job status requests
+    poll_interval: float = 2.0
+    # max seconds to wait for a job, None waits until the job finishes
+    timeout: Optional[float] = None
+    # consume the server-sent events of /transcribe_stream instead of polling a job
+    stream: bool = False
+
+
+# language value of the service that detects the language
+AUTO_LANGUAGE = "auto"
+# timeout of a single http request, the transcription itself runs as a job
+REQUEST_TIMEOUT = 60
 
 
 def convert_language(text: str, mode: str = "s2twp"):
@@ -21,13 +38,124 @@ def convert_language(text: str, mode: str = "s2twp"):
     return opencc.OpenCC(mode).convert(text)
 
 
+def submit_job_data(data: Union[BinaryIO, Iterable[bytes]], filename: str, stt_config: STTConfig) -> str:
+    """upload a file object or an iterable of bytes as a transcription job, return the job id
+    the data is streamed as the raw request body, the service decodes it while receiving
+    """
+    response = requests.post(
+        f"{stt_config.base_url}/jobs/raw",
+        data=data,
+        params={"filename": filename, "language": stt_config.language or AUTO_LANGUAGE},
+        headers={"Content-Type": "application/octet-stream"},
+        timeout=REQUEST_TIMEOUT,
+    )
+    response.raise_for_status()
+    return response.json()["job_id"]
+
+
+def submit_job(file_path: str, stt_config: STTConfig) -> str:
+    """upload the file as a transcription job, return the job id"""
+    with open(file_path, "rb") as f:
+        return submit_job_data(f, os.path.basename(file_path), stt_config)
+
+
+def cancel_job(job_id: str, stt_config: STTConfig):
+    requests.delete(f"{stt_config.base_url}/jobs/{job_id}", timeout=REQUEST_TIMEOUT)
+
+
+def wait_job(job_id: str, stt_config: STTConfig) -> dict:
+    """poll the job until it finishes, return the transcriptions"""
+    start_time = time.time()
+    while True:
+        response = requests.get(
+            f"{stt_config.base_url}/jobs/{job_id}", timeout=REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        job = response.json()
+        if job["status"] == "done":
+            break
+        if job["status"] in ("failed", "cancelled"):
+            raise RuntimeError(f"transcription job {job_id} {job['status']}: {job.get('error')}")
+        if stt_config.timeout is not None and time.time() - start_time > stt_config.timeout:
+            cancel_job(job_id, stt_config)
+            raise TimeoutError(f"transcription job {job_id} timeout after {stt_config.timeout}s")
+        time.sleep(stt_config.poll_interval)
+    response = requests.get(
+        f"{stt_config.base_url}/jobs/{job_id}/result", timeout=REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def iter_events(response: requests.Response) -> Iterator[tuple]:
+    """parse server-sent events, yield (event, data)"""
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith(":"):
+            continue
+        elif line.startswith("event:"):
+            event = line[len("event:") :].strip()
+        elif line.startswith("data:"):
+            data.append(line[len("data:") :].strip())
+
+
+def stream_transcription_data(
+    data: Union[BinaryIO, Iterable[bytes]], filename: str, stt_config: STTConfig
+) -> Iterator[dict]:
+    """transcribe a file object or an iterable of bytes
+    yield each segment {"text", "start", "end"} as soon as it is transcribed
+    """
+    if stt_config.provider != "custom":
+        raise ValueError(f"provider {stt_config.provider} is not supported")
+    start_time = time.time()
+    response = requests.post(
+        f"{stt_config.base_url}/transcribe_stream",
+        data=data,
+        params={"filename": filename, "language": stt_config.language or AUTO_LANGUAGE},
+        headers={"Content-Type": "application/octet-stream"},
+        stream=True,
+        timeout=REQUEST_TIMEOUT,
+    )
+    with response:
+        response.raise_for_status()
+        for event, data in iter_events(response):
+            if event == "transcription":
+                yield json.loads(data)
+            elif event == "done":
+                return
+            elif event == "error":
+                job = json.loads(data)
+                raise RuntimeError(f"transcription job {job['id']} {job['status']}: {job.get('error')}")
+            if stt_config.timeout is not None and time.time() - start_time > stt_config.timeout:
+                # closing the stream cancels the job
+                raise TimeoutError(f"transcription timeout after {stt_config.timeout}s")
+    raise RuntimeError("transcription stream closed before the end")
+
+
+def stream_transcription(file_path: str, stt_config: STTConfig) -> Iterator[dict]:
+    """transcribe audio, yield each segment {"text", "start", "end"} as soon as it is transcribed"""
+    with open(file_path, "rb") as f:
+        yield from stream_transcription_data(f, os.path.basename(file_path), stt_config)
+
+
+def transcribe_data(data: Union[BinaryIO, Iterable[bytes]], filename: str, stt_config: STTConfig) -> str:
+    """transcribe a file object or an iterable of bytes to text, e.g. a download stream"""
+    if stt_config.provider != "custom":
+        raise ValueError(f"provider {stt_config.provider} is not supported")
+    if stt_config.stream:
+        segments = stream_transcription_data(data, filename, stt_config)
+        transcript = "\n".join(x["text"] for x in segments)
+        return convert_language(transcript, "s2twp")
+    job_id = submit_job_data(data, filename, stt_config)
+    transcriptions = wait_job(job_id, stt_config)
+    return convert_language(transcriptions["transcript"], "s2twp")
+
+
 def transcribe_audio(file_path: str, stt_config: STTConfig) -> str:
     """transcribe audio to text"""
-    if stt_config.provider == "custom":
-        url = f"{stt_config.base_url}/transcribe"
-    else:
-        raise ValueError(f"provider {stt_config.provider} is not supported")
-    files = {"file": open(file_path, "rb")}
-    response = requests.post(url, files=files)
-    response.raise_for_status()
-    return convert_language(response.json()["transcript"], "s2twp")
+    with open(file_path, "rb") as f:
+        return transcribe_data(f, os.path.basename(file_path), stt_config)
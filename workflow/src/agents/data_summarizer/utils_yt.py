@@ -1,44 +1,68 @@
 """Download and transcribe youtube video"""
 
-from typing import Optional
+from typing import List, Optional, Tuple
 
-import os
-import tempfile
-from pytubefix import YouTube
-from src.agents.data_summarizer.utils_stt import transcribe_audio, STTConfig
+from pytubefix import YouTube, request
+from src.agents.data_summarizer.utils_stt import transcribe_data, STTConfig
 from loguru import logger
-import time
-def extract_youtube_transcript(url: str, stt_config: Optional[STTConfig] = None) -> str:
-    """get the transcript of the youtube video
+
+# prefix of the auto generated caption codes
+AUTO_CAPTION_PREFIX = "a."
+
+
+def get_caption_language(code: str) -> str:
+    if code.startswith(AUTO_CAPTION_PREFIX):
+        code = code[len(AUTO_CAPTION_PREFIX) :]
+    return code.lower()
+
+
+def select_caption(caption_tracks: List, language: Optional[str]):
+    """select the caption in the language, manual captions before auto generated ones
+    falls back to the first caption when none is in the language
+    """
+    if len(caption_tracks) == 0:
+        return None
+    if language is not None:
+        language = language.lower()
+        manual = [x for x in caption_tracks if not x.code.startswith(AUTO_CAPTION_PREFIX)]
+        auto = [x for x in caption_tracks if x.code.startswith(AUTO_CAPTION_PREFIX)]
+        for tracks in (manual, auto):
+            for track in tracks:
+                caption_language = get_caption_language(track.code)
+                # zh matches zh, zh-TW, zh-Hant...
+                if caption_language == language or caption_language.startswith(f"{language}-"):
+                    return track
+    return caption_tracks[0]
+
+
+def transcribe_audio_stream(yt: YouTube, stt_config: STTConfig) -> str:
+    """stream the smallest audio only stream to the speech to text service"""
+    stream = yt.streams.filter(only_audio=True).order_by("abr").first()
+    if stream is None:
+        raise ValueError(f"No audio stream found for {yt.watch_url}")
+    extension = "m4a" if stream.subtype == "mp4" else stream.subtype
+    logger.debug(f"Audio stream: {stream.mime_type} {stream.abr} {stream.filesize} bytes")
+    # range requests of pytubefix, a single request is throttled by youtube
+    return transcribe_data(request.stream(stream.url), f"audio.{extension}", stt_config)
+
+
+def extract_youtube(url: str, stt_config: Optional[STTConfig] = None) -> Tuple[str, str]:
+    """get the title and the transcript of the youtube video
+    captions are used when available, otherwise the audio is transcribed
     ARGS:
         url: the url of the youtube video
-        stt_config: the config for the speech to text model
+        stt_config: the config for the speech to text model, its language selects the caption
     RETURNS:
-        the transcript of the youtube video
+        the title and the transcript of the youtube video
     """
-    logger.debug(f"[UTILS_YT]-extract_youtube_transcript: {url}")
-    with tempfile.TemporaryDirectory() as temp_dir:
-        os.makedirs(temp_dir, exist_ok=True)
-        yt = YouTube(url)
-        if len(yt.caption_tracks) > 0:
-            logger.debug(f"Found captions:{yt.caption_tracks}")
-            caption = yt.caption_tracks[0]
-            caption.download(output_path=temp_dir, title="transcript", srt=True)
-            file_path = [x.path for x in os.scandir(temp_dir)][0]
-            with open(file_path, "r") as f:
-                transcript = f.read()
-            return transcript
-        else:
-            logger.warning("No caption found for the youtube video")
-            if stt_config is None:
-                raise ValueError("stt_config is required for youtube without caption")
-            file_name = f"{time.time()}.mp3"
-            file_path = yt.streams.get_lowest_resolution().download(output_path=temp_dir, filename=file_name)
-            transcript = transcribe_audio(file_path, stt_config)
-            # os.remove(file_path)
-            return transcript
-
-
-def get_yt_title(url: str) -> str:
-    """get the title of the youtube video"""
-    return YouTube(url).title
+    logger.debug(f"[UTILS_YT]-extract_youtube: {url}")
+    yt = YouTube(url)
+    language = stt_config.language if stt_config is not None else None
+    caption = select_caption(yt.caption_tracks, language)
+    if caption is not None:
+        logger.debug(f"Use caption: {caption.code}")
+        return yt.title, caption.generate_srt_captions()
+    logger.warning("No caption found for the youtube video")
+    if stt_config is None:
+        raise ValueError("stt_config is required for youtube without caption")
+    return yt.title, transcribe_audio_stream(yt, stt_config)
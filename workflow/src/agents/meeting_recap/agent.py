@@ -1,6 +1,7 @@
 """MEETING RECAP AGENT"""
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import TypedDict, Optional
 from pydantic import BaseModel
 from loguru import logger
@@ -21,7 +22,12 @@ from langchain_core.messages import (
 from src.llm.config import LLMConfig, LLMModelType
 from src.llm.lc import llm_factory, tools_factory
 from src.llm.config import LLMModelType
-from src.agents.meeting_recap.utils import transcribe_audio, STTConfig, convert_language
+from src.agents.meeting_recap.utils import (
+    transcribe_audio,
+    stream_transcription,
+    STTConfig,
+    convert_language,
+)
 
 
 class State(TypedDict):
@@ -31,12 +37,19 @@ class State(TypedDict):
     transcription: str
     summary: str
     format_instruction: str
+    # streamed transcription: summaries of the early parts and the raw last part
+    partial_summaries: list[str]
+    transcription_tail: str
 
 
 class AgentConfig(BaseModel):
     """configuration of the chatbot"""
     chat_llm: LLMConfig
     stt_config: STTConfig
+    # summarize early parts of the transcript while the rest is transcribed
+    stream_transcription: bool = False
+    # characters of transcript per partial summary
+    map_chunk_size: int = 4000
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -56,6 +69,30 @@ TRANSCRIPT_PROMPT = """
 </format>
 """
 
+MAP_PROMPT = """
+以下是會議逐字稿的其中一段，以<transcription>標籤包住。
+<transcription>
+`{transcription}`
+</transcription>
+請詳細整理這段逐字稿的內容，保留討論項目、討論過程中的詳細內容與數據、討論結果與行動項目。
+不許額外加入逐字稿以外的內容。
+"""
+
+REDUCE_PROMPT = """
+會議前段的重點整理以<summaries>標籤包住，會議最後一段的逐字稿以<transcription>標籤包住。
+<summaries>
+{summaries}
+</summaries>
+<transcription>
+`{transcription}`
+</transcription>
+回答的內容需要參考上述整理與逐字稿的內容，不要私自添加以外的內容。
+您是一位專業的文件整理人員，需要整理出針對整場會議的內容，請根據<format>標籤的要求進行整理。
+<format>
+{format}
+</format>
+"""
+
 DEFAULT_SUMMARY_FORMAT = """
 需要整理出以下內容，列出每個討論項目與每個討論項目的詳細內容。
 討論項目：
@@ -71,6 +108,8 @@ class Agent:
     def __init__(self, agent_config: AgentConfig):
         self.llm = llm_factory(agent_config.chat_llm)
         self.stt_config = agent_config.stt_config
+        self.stream_transcription = agent_config.stream_transcription
+        self.map_chunk_size = agent_config.map_chunk_size
 
     def insert_system_prompt(self, messages: list[BaseMessage]):
         """insert the system prompt"""
@@ -99,10 +138,42 @@ class Agent:
             file_path = state["file_path"]
             if not os.path.exists(file_path):
                 raise FileNotFoundError(f"file not found: {file_path}")
-            transcription = transcribe_audio(file_path, self.stt_config)
-            state["transcription"] = transcription
+            if self.stream_transcription:
+                state.update(self.transcribe_and_map(file_path))
+            else:
+                state["transcription"] = transcribe_audio(file_path, self.stt_config)
         return state
 
+    def map_summarize(self, transcription: str) -> str:
+        """summarize a part of the transcript"""
+        response = self.llm.invoke(
+            [HumanMessage(content=MAP_PROMPT.format(transcription=transcription))]
+        )
+        return convert_language(response.content, "s2twp")
+
+    def transcribe_and_map(self, file_path: str) -> dict:
+        """stream the transcription, summarize every map_chunk_size characters while the rest is transcribed
+        the last part is kept as is for the final summary
+        """
+        texts, buffer, buffer_size = [], [], 0
+        futures = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for segment in stream_transcription(file_path, self.stt_config):
+                text = convert_language(segment["text"], "s2twp")
+                texts.append(text)
+                buffer.append(text)
+                buffer_size += len(text)
+                if buffer_size >= self.map_chunk_size:
+                    logger.debug(f"[MEETING RECAP-TRANSCRIBE]-map part {len(futures)}")
+                    futures.append(executor.submit(self.map_summarize, "\n".join(buffer)))
+                    buffer, buffer_size = [], 0
+            partial_summaries = [future.result() for future in futures]
+        return {
+            "transcription": "\n".join(texts),
+            "partial_summaries": partial_summaries,
+            "transcription_tail": "\n".join(buffer),
+        }
+
     def summarize(self, state: State, **kwargs):
         """summarize the meeting"""
         logger.debug(f"[MEETING RECAP-SUMMARIZE]-state: {state}")
@@ -112,13 +183,18 @@ class Agent:
         format_instruction = (
             state.get("format_instruction", None) or DEFAULT_SUMMARY_FORMAT
         )
-        messages = [
-            HumanMessage(
-                content=TRANSCRIPT_PROMPT.format(
-                    transcription=transcription, format=format_instruction
-                )
-            ),
-        ]
+        partial_summaries = state.get("partial_summaries", None)
+        if partial_summaries:
+            content = REDUCE_PROMPT.format(
+                summaries="\n\n".join(partial_summaries),
+                transcription=state.get("transcription_tail", ""),
+                format=format_instruction,
+            )
+        else:
+            content = TRANSCRIPT_PROMPT.format(
+                transcription=transcription, format=format_instruction
+            )
+        messages = [HumanMessage(content=content)]
         response = self.llm.invoke(messages)
         response.content = convert_language(response.content, "s2twp")
         state["summary"] = response.content
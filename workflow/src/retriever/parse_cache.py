@@ -0,0 +1,100 @@
+"""Cache of parsed documents keyed by file hash
+
+The same file is parsed once for the retriever and the data summarizer. Entries are
+kept in memory (LRU) and, when PARSE_CACHE_DIR is set, as json files shared between
+processes.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from langchain_core.documents import Document
+from loguru import logger
+
+PARSE_CACHE_DIR = os.getenv("PARSE_CACHE_DIR", "")
+PARSE_CACHE_MAX_ITEMS = int(os.getenv("PARSE_CACHE_MAX_ITEMS", 32))
+# bump when the output of a parser changes, older entries are ignored
+PARSER_VERSION = 2
+FILE_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(FILE_HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class ParseCache:
+    """parsed documents by file hash and extension"""
+
+    def __init__(self, cache_folder: Optional[str] = None, max_items: int = PARSE_CACHE_MAX_ITEMS):
+        self.cache_folder = cache_folder or None
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        self.items: "OrderedDict[str, List[dict]]" = OrderedDict()
+        if self.cache_folder:
+            os.makedirs(self.cache_folder, exist_ok=True)
+
+    def get_key(self, path: str, file_extension: str) -> str:
+        return f"{hash_file(path)}-{file_extension}-v{PARSER_VERSION}"
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_folder, f"{key}.json")
+
+    def get(self, key: str, path: str) -> Optional[List[Document]]:
+        """cached documents of the key, the source of the documents is set to path"""
+        with self.lock:
+            items = self.items.get(key)
+            if items is not None:
+                self.items.move_to_end(key)
+        if items is None and self.cache_folder:
+            try:
+                with open(self.get_path(key), "r", encoding="utf-8") as f:
+                    items = json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                logger.warning(f"[PARSE_CACHE] invalid entry removed: {key}")
+                # another process may have removed or replaced it already
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.get_path(key))
+            if items is not None:
+                self.put_memory(key, items)
+        if items is None:
+            return None
+        return [
+            Document(page_content=item["page_content"], metadata={**item["metadata"], "source": path})
+            for item in items
+        ]
+
+    def put_memory(self, key: str, items: List[dict]):
+        with self.lock:
+            self.items[key] = items
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def put(self, key: str, docs: List[Document]):
+        items = [{"page_content": doc.page_content, "metadata": dict(doc.metadata)} for doc in docs]
+        self.put_memory(key, items)
+        if self.cache_folder:
+            path = self.get_path(key)
+            # unique per process and thread, readers only see complete entries
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(items, f, ensure_ascii=False)
+                os.replace(temp_path, path)
+            finally:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp_path)
+
+
+parse_cache = ParseCache(PARSE_CACHE_DIR)
@@ -0,0 +1,243 @@
+"""Parallel document parsing
+
+Large pdfs are split by page range and workbooks by sheet, the parts are parsed in
+child processes (parse_worker.py) and yielded in document order as soon as they are
+ready, so the first chunks can be split and embedded while the rest is still parsed.
+Text, markdown, csv (one document per row), json, html and xml are read with native parsers, other formats
+(and native parses that fail) are loaded with the loader of PARSERS.
+Parsed documents are cached by file hash, see parse_cache.
+"""
+
+import csv
+import json
+import os
+import subprocess
+import sys
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import Future, ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import Iterator, List, Optional
+
+from langchain_core.documents import Document
+from loguru import logger
+
+from src.retriever import parse_worker
+from src.retriever.parse_cache import parse_cache
+from src.retriever.parser import PARSERS
+
+# pages parsed by a single task
+PDF_PAGES_PER_TASK = 25
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+# script run by each parse task
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parse_worker.py")
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ThreadPoolExecutor:
+    """pool shared by all parses, each thread runs a parse task in a child process
+    the child runs parse_worker.py as a script: unlike a multiprocessing pool it does
+    not re-import the __main__ module of the application (mail bot, streamlit)
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="parse")
+        return _pool
+
+
+def to_documents(items: List[dict]) -> List[Document]:
+    return [Document(page_content=x["page_content"], metadata=x["metadata"]) for x in items]
+
+
+def run_worker(*args: str) -> List[Document]:
+    """run a parse task of parse_worker.py in a child process"""
+    process = subprocess.run(
+        [sys.executable, WORKER_PATH, *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if process.returncode != 0:
+        stderr = process.stderr.decode("utf-8", errors="ignore").strip()
+        raise RuntimeError(f"Parse task {args[:3]} failed: {stderr.splitlines()[-1] if stderr else process.returncode}")
+    return to_documents(json.loads(process.stdout))
+
+
+def count_pdf_pages(path: str) -> int:
+    from pypdf import PdfReader
+
+    return len(PdfReader(path).pages)
+
+
+def list_sheets(path: str) -> List[str]:
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True)
+    try:
+        return workbook.sheetnames
+    finally:
+        workbook.close()
+
+
+def iter_futures(futures: List[Future]) -> Iterator[Document]:
+    """yield the documents of the futures in order, pending futures are cancelled on close"""
+    try:
+        for future in futures:
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def iter_pdf(path: str, pages_per_task: int = PDF_PAGES_PER_TASK) -> Iterator[Document]:
+    num_pages = count_pdf_pages(path)
+    if num_pages <= pages_per_task:
+        yield from to_documents(parse_worker.parse_pdf_pages(path, 0, num_pages))
+        return
+    logger.debug(f"Parse {num_pages} pages in parallel: {path}")
+    pool = get_pool()
+    futures = [
+        pool.submit(run_worker, "pdf", path, str(start), str(start + pages_per_task))
+        for start in range(0, num_pages, pages_per_task)
+    ]
+    yield from iter_futures(futures)
+
+
+def iter_workbook(path: str) -> Iterator[Document]:
+    sheet_names = list_sheets(path)
+    if len(sheet_names) <= 1:
+        for sheet_name in sheet_names:
+            yield from to_documents(parse_worker.parse_sheet(path, sheet_name))
+        return
+    logger.debug(f"Parse {len(sheet_names)} sheets in parallel: {path}")
+    pool = get_pool()
+    futures = [pool.submit(run_worker, "sheet", path, sheet_name) for sheet_name in sheet_names]
+    yield from iter_futures(futures)
+
+
+def read_text(path: str) -> str:
+    with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+        return f.read()
+
+
+def parse_text(path: str) -> List[Document]:
+    """txt, md and json as plain text"""
+    return [Document(page_content=read_text(path), metadata={"source": path})]
+
+
+def parse_csv(path: str) -> List[Document]:
+    """one document per row like CSVLoader, "column: value" lines"""
+    docs = []
+    with open(path, "r", newline="", encoding="utf-8-sig", errors="replace") as f:
+        for idx, row in enumerate(csv.DictReader(f)):
+            lines = []
+            for key, value in row.items():
+                if isinstance(value, list):
+                    # values of a row longer than the header
+                    value = ",".join(x.strip() for x in value)
+                lines.append(f"{key.strip() if key is not None else key}: {value.strip() if value is not None else ''}")
+            docs.append(Document(page_content="\n".join(lines), metadata={"source": path, "row": idx}))
+    return docs
+
+
+class HTMLTextParser(HTMLParser):
+    """collect the visible text of a html page"""
+
+    SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "head"}
+    BLOCK_TAGS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "table"}
+
+    def __init__(self):
+        super().__init__()
+        self.texts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.texts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS and self.skip_depth > 0:
+            self.skip_depth -= 1
+        elif tag in self.BLOCK_TAGS:
+            self.texts.append("\n")
+
+    def handle_data(self, data):
+        if self.skip_depth == 0 and data.strip():
+            self.texts.append(data.strip())
+
+    def get_text(self) -> str:
+        lines = " ".join(self.texts).split("\n")
+        return "\n".join(line.strip() for line in lines if line.strip())
+
+
+def parse_html(path: str) -> List[Document]:
+    parser = HTMLTextParser()
+    parser.feed(read_text(path))
+    parser.close()
+    return [Document(page_content=parser.get_text(), metadata={"source": path})]
+
+
+def parse_xml(path: str) -> List[Document]:
+    root = ET.parse(path).getroot()
+    texts = [text.strip() for text in root.itertext() if text.strip()]
+    return [Document(page_content="\n".join(texts), metadata={"source": path})]
+
+
+# formats parsed without unstructured
+FAST_PARSERS = {
+    "txt": parse_text,
+    "md": parse_text,
+    "csv": parse_csv,
+    "json": parse_text,
+    "html": parse_html,
+    "xml": parse_xml,
+}
+
+
+def parse_documents(path: str, file_extension: str) -> Iterator[Document]:
+    if file_extension == "pdf":
+        yield from iter_pdf(path)
+    elif file_extension == "xlsx":
+        yield from iter_workbook(path)
+    elif file_extension in FAST_PARSERS:
+        try:
+            docs = FAST_PARSERS[file_extension](path)
+        except Exception as e:
+            if file_extension not in PARSERS:
+                raise
+            logger.warning(f"Fast parser failed, fall back to {PARSERS[file_extension].__name__}: {e}")
+            docs = PARSERS[file_extension](path).lazy_load()
+        yield from docs
+    elif file_extension in PARSERS:
+        yield from PARSERS[file_extension](path).lazy_load()
+    else:
+        raise ValueError(f"File extension {file_extension} is not supported")
+
+
+def iter_documents(path: str, file_extension: str) -> Iterator[Document]:
+    """parse the file, yield documents in order as they are parsed
+    a file parsed before is served from the parse cache
+    """
+    file_extension = file_extension.lower()
+    key = parse_cache.get_key(path, file_extension)
+    docs = parse_cache.get(key, path)
+    if docs is not None:
+        logger.debug(f"[PARSE_CACHE] hit: {path}")
+        yield from docs
+        return
+    docs = []
+    for doc in parse_documents(path, file_extension):
+        docs.append(doc)
+        yield doc
+    # only complete parses are cached
+    parse_cache.put(key, docs)
+
+
+def split_documents(docs: Iterator[Document], splitter) -> Iterator[Document]:
+    """split documents one by one, chunks are yielded before the next document is parsed"""
+    for doc in docs:
+        yield from splitter.split_documents([doc])
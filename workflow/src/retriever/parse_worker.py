@@ -0,0 +1,60 @@
+"""Parse worker of parse_engine
+
+Runs as a script in a child process, so the worker only imports the parsing library
+and never the modules (and import-time side effects) of the parent application.
+Only the standard library is imported at module level.
+
+usage:
+    python parse_worker.py pdf <path> <start> <end>
+    python parse_worker.py sheet <path> <sheet_name>
+prints the parsed documents as a json list of {"page_content", "metadata"}
+"""
+
+import json
+import sys
+from typing import List
+
+
+def parse_pdf_pages(path: str, start: int, end: int) -> List[dict]:
+    """parse the pages [start, end) of the pdf, one document per page like PyPDFLoader"""
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    return [
+        {
+            "page_content": reader.pages[idx].extract_text(),
+            "metadata": {"source": path, "page": idx},
+        }
+        for idx in range(start, min(end, len(reader.pages)))
+    ]
+
+
+def parse_sheet(path: str, sheet_name: str) -> List[dict]:
+    """parse a sheet of the workbook as csv text"""
+    import pandas as pd
+
+    df = pd.read_excel(path, sheet_name=sheet_name, header=None, dtype=str)
+    df = df.dropna(how="all").dropna(axis=1, how="all")
+    if df.empty:
+        return []
+    return [
+        {
+            "page_content": df.to_csv(index=False, header=False),
+            "metadata": {"source": path, "sheet": sheet_name},
+        }
+    ]
+
+
+def main(args: List[str]):
+    kind, path = args[0], args[1]
+    if kind == "pdf":
+        docs = parse_pdf_pages(path, int(args[2]), int(args[3]))
+    elif kind == "sheet":
+        docs = parse_sheet(path, args[2])
+    else:
+        raise ValueError(f"Unknown parse task: {kind}")
+    json.dump(docs, sys.stdout, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,50 +1,51 @@
-from langchain_community.document_loaders import (
-    PyPDFLoader,
-    TextLoader,
-    Docx2txtLoader,
-    CSVLoader,
-    JSONLoader,
-    UnstructuredMarkdownLoader,
-    UnstructuredHTMLLoader,
-    UnstructuredFileLoader,
-    UnstructuredImageLoader,
-    UnstructuredWordDocumentLoader,
-    UnstructuredPowerPointLoader,
-    UnstructuredPDFLoader,
-    UnstructuredExcelLoader,
-    UnstructuredODTLoader,
-    UnstructuredRTFLoader,
-    WebBaseLoader,
-    UnstructuredXMLLoader,
-)
+from typing import Callable
+
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+
+def lazy_loader(class_name: str) -> Callable:
+    """loader class of langchain_community imported on first use, unstructured loaders are slow to import"""
+
+    def create_loader(*args, **kwargs):
+        from langchain_community import document_loaders
+
+        return getattr(document_loaders, class_name)(*args, **kwargs)
+
+    create_loader.__name__ = class_name
+    return create_loader
+
+
 PARSERS = {
-    "pdf": PyPDFLoader,
-    "txt": TextLoader,
-    "docx": Docx2txtLoader,
-    "csv": CSVLoader,
-    "json": JSONLoader,
-    "md": UnstructuredMarkdownLoader,
-    "html": UnstructuredHTMLLoader,
-    "file": UnstructuredFileLoader,
-    "image": UnstructuredImageLoader,
-    "doc": UnstructuredWordDocumentLoader,
-    "xls": UnstructuredExcelLoader,
-    "xlsx": UnstructuredExcelLoader,
-    "ppt": UnstructuredPowerPointLoader,
-    "pptx": UnstructuredPowerPointLoader,
-    "xml": UnstructuredXMLLoader,
-    "http": WebBaseLoader,
+    "pdf": lazy_loader("PyPDFLoader"),
+    "txt": lazy_loader("TextLoader"),
+    "docx": lazy_loader("Docx2txtLoader"),
+    "csv": lazy_loader("CSVLoader"),
+    "json": lazy_loader("JSONLoader"),
+    "md": lazy_loader("UnstructuredMarkdownLoader"),
+    "html": lazy_loader("UnstructuredHTMLLoader"),
+    "file": lazy_loader("UnstructuredFileLoader"),
+    "image": lazy_loader("UnstructuredImageLoader"),
+    "doc": lazy_loader("UnstructuredWordDocumentLoader"),
+    "xls": lazy_loader("UnstructuredExcelLoader"),
+    "xlsx": lazy_loader("UnstructuredExcelLoader"),
+    "ppt": lazy_loader("UnstructuredPowerPointLoader"),
+    "pptx": lazy_loader("UnstructuredPowerPointLoader"),
+    "xml": lazy_loader("UnstructuredXMLLoader"),
+    "http": lazy_loader("WebBaseLoader"),
 }
 
 
-def splitter_factory(chunk_size: int, chunk_overlap: int):
-    """splitter factory"""
+def splitter_factory(
+    chunk_size: int, chunk_overlap: int, length_function: Callable[[str], int] = len
+):
+    """splitter factory
+    length_function: size of a text, characters by default, e.g. estimated tokens
+    """
     # TODO: add more splitter
     return RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
+        length_function=length_function,
         separators=[
             "\n\n",
             "\n",
@@ -6,6 +6,7 @@ from src.retriever.vector_store import (
     vector_store_factory,
 )
 from src.retriever.parser import splitter_factory, PARSERS
+from src.retriever.parse_engine import iter_documents, split_documents
 from src.retriever.vector_store import (
     VectorStoreProvider,
     bm25_retriever_factory,
@@ -127,15 +128,24 @@ class Retriever:
         if data_extension not in PARSERS:
             raise ValueError(f"Invalid data extension: {data_extension}")
         logger.debug(f"Start insert data: {data_path}")
-        loader = PARSERS[data_extension](data_path)
-        docs = loader.load_and_split(self.splitter)
-        for idx in range(0, len(docs), self.insert_batch_size):
-            for doc in docs[idx : idx + self.insert_batch_size]:
-                doc.metadata["source"] = data_path
-                doc.metadata["file_name"] = os.path.basename(data_path)
-                doc.metadata["enabled"] = True
-            self.vector_store.add_documents(docs[idx : idx + self.insert_batch_size])
-            logger.debug(f"Progress:[{idx+1}/{len(docs)}]-{data_path}")
+        # chunks are embedded while the rest of the file is parsed
+        docs = []
+        batch = []
+        for doc in split_documents(
+            iter_documents(data_path, data_extension), self.splitter
+        ):
+            doc.metadata["source"] = data_path
+            doc.metadata["file_name"] = os.path.basename(data_path)
+            doc.metadata["enabled"] = True
+            docs.append(doc)
+            batch.append(doc)
+            if len(batch) == self.insert_batch_size:
+                self.vector_store.add_documents(batch)
+                batch = []
+                logger.debug(f"Progress:[{len(docs)}]-{data_path}")
+        if batch:
+            self.vector_store.add_documents(batch)
+        logger.debug(f"Progress:[{len(docs)}/{len(docs)}]-{data_path}")
 
         if not self.use_memory:
             # save data to folder
@@ -187,6 +197,22 @@ class Retriever:
             self.bm25_retriever = bm25_retriever_factory(all_docs, self.top_k)
         return all_docs
 
+    def insert_texts(self, texts: list[str], metadatas: Optional[list[dict]] = None):
+        """split and insert texts into the vector store, e.g. extracted content
+        texts are not saved to the sqlite database
+
+        texts: list[str], list of texts
+        metadatas: list[dict], optional, metadata of each text
+        """
+        metadatas = metadatas or [{} for _ in texts]
+        docs = self.splitter.create_documents(texts, metadatas=metadatas)
+        for idx in range(0, len(docs), self.insert_batch_size):
+            self.vector_store.add_documents(docs[idx : idx + self.insert_batch_size])
+            logger.debug(f"Progress:[{idx+1}/{len(docs)}]-texts")
+        if self.use_bm25 and len(docs) > 0:
+            self.bm25_retriever = bm25_retriever_factory(docs, self.top_k)
+        return docs
+
     def setup_rag_retriever(self, top_k: int):
         """setup rag retriever"""
         if self.bm25_retriever: